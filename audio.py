@@ -1,31 +1,225 @@
+import hashlib
+import mmap
 import os
-from pydub import AudioSegment
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import struct
 import subprocess
-import torch
-import torchaudio
+import threading
 from Misc_enums import *
 
+import numpy as np
+
+from cache import EncodeCache
+from instrumentation import span
+from mixer import get_mixer
 from utils import *
 
-def is_silent(file_path, threshold_db=-60):
-    audio = AudioSegment.from_file(file_path)
-    max_amplitude_db = audio.max_dBFS
-    return max_amplitude_db <= threshold_db
+# maximum number of ffmpeg processes encoding samples at once, and how long (in seconds) a single encode may take
+ENCODE_WORKERS = os.cpu_count() or 1
+ENCODE_TIMEOUT = 300
+# pipe sample payloads straight from the container into ffmpeg instead of extracting them to temporary files first
+STREAM_TO_ENCODER = True
+# Vorbis quality of encoded samples
+ENCODE_QUALITY = 9
+# where encoded samples are cached across songs and containers (None disables the cache), and its size limit in bytes
+ENCODE_CACHE_DIR = os.path.join(".", "cache", "samples")
+ENCODE_CACHE_SIZE = 4 * 1024 ** 3
+# memory cap in bytes of each song's pool of decoded background samples
+DECODED_POOL_SIZE = 1024 ** 3
+# number of samples (at 44.1 kHz) mixed at a time when streaming background audio to the encoder
+BGM_BLOCK_SIZE = 44100 * 10
+# backend used to decode, resample and mix background samples: "numpy", or "torch" to use PyTorch
+MIXER_BACKEND = "numpy"
+# samples whose peak is at or below this level (in dBFS) are silent: they aren't encoded or mixed, and their sound
+# channels all point to a single silent placeholder in their container's output directory
+SILENCE_THRESHOLD_DB = -60
+SILENT_SAMPLE_FILENAME = "silence.ogg"
+
+# PCM sample formats that can be scanned without decoding, by (format tag, bits per sample)
+PCM_FORMATS = {(1, 8): "u1", (1, 16): "<i2", (1, 32): "<i4", (3, 32): "<f4"}
+WAVE_FORMAT_ADPCM = 2
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+# Whether a sample is silent, judged straight from the .wav data in its payload: the peak of PCM frames is found
+# with NumPy, and MS ADPCM blocks count as silent when every block starts at a quiet sample and never moves away
+# from it. Returns None when that can't be told without decoding the sample (other codecs, WMA).
+def is_silent_payload(payload, threshold_db=SILENCE_THRESHOLD_DB):
+    data = memoryview(payload)
+    if len(data) < 12 or data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        return None
+
+    (format_tag, channels, block_align, bits_per_sample, frames) = (None, 1, 0, 0, None)
+    offset = 12
+    while offset + 8 <= len(data):
+        (chunk_id, chunk_size) = struct.unpack_from("<4sI", data, offset)
+        if chunk_id == b'fmt ' and chunk_size >= 16:
+            (format_tag, channels, _, _, block_align, bits_per_sample) = struct.unpack_from("<HHIIHH", data, offset + 8)
+            if format_tag == WAVE_FORMAT_EXTENSIBLE and chunk_size >= 26:
+                # the actual format is the first field of the sub-format GUID
+                format_tag = struct.unpack_from("<H", data, offset + 32)[0]
+        elif chunk_id == b'data':
+            frames = data[offset + 8:min(offset + 8 + chunk_size, len(data))]
+            break
+        offset += 8 + chunk_size + chunk_size % 2
+    if format_tag is None or frames is None:
+        return None
+
+    threshold = 10 ** (threshold_db / 20)
+    if (format_tag, bits_per_sample) in PCM_FORMATS:
+        dtype = np.dtype(PCM_FORMATS[(format_tag, bits_per_sample)])
+        samples = np.frombuffer(frames, dtype=dtype, count=len(frames) // dtype.itemsize)
+        if len(samples) == 0:
+            return True
+        if dtype.kind == "f":
+            return float(np.max(np.abs(samples))) <= threshold
+        if dtype.kind == "u":
+            # 8-bit PCM is unsigned, centered on 128
+            return max(int(samples.max()) - 128, 128 - int(samples.min())) <= threshold * 128
+        full_scale = 2 ** (bits_per_sample - 1)
+        return max(int(samples.max()), -int(samples.min())) <= threshold * full_scale
+
+    if format_tag == WAVE_FORMAT_ADPCM and block_align > 7 * channels:
+        # each block: predictor indices, deltas, then the two starting samples of every channel, then 4-bit codes.
+        # With the first predictor (which repeats the previous sample) and all-zero codes, a block just holds its
+        # starting sample, so its peak is known without decoding anything.
+        padding = -len(frames) % block_align
+        blocks = np.frombuffer(bytes(frames) + bytes(padding), dtype="u1").reshape(-1, block_align)
+        if blocks[:, :channels].any() or blocks[:, 7 * channels:].any():
+            return None
+        starting_samples = np.ascontiguousarray(blocks[:, 3 * channels:7 * channels]).view("<i2").astype(np.int32)
+        return int(np.abs(starting_samples).max(initial=0)) <= threshold * 32768
+    return None
 
 
 def trim_start_silence(file_path):
+    # pydub takes seconds and hundreds of MB to import, so it's only imported by the functions that use it:
+    # chart-only work and fresh worker processes don't pay for it
+    from pydub import AudioSegment
+
     audio = AudioSegment.from_file(file_path, format="ogg")
 
     portion_to_remove = 8  # milliseconds
     audio_without_portion = audio[portion_to_remove:]
 
     audio_without_portion.export(file_path, format="ogg")
-    print(f"Trimmed the first {portion_to_remove}ms of silence from {os.path.basename(file_path)}.")
-
+    trace("Trimmed the first %sms of silence from %s.", portion_to_remove, os.path.basename(file_path))
+
+
+# A single audio sample inside a container: its index, audio format (wav or wma), and where its payload is
+ContainerSample = namedtuple("ContainerSample", ["index", "format", "offset", "size"])
+
+
+# Memory-mapped .2dx/.s3p audio container. The offset table is parsed once on open, and each sample's
+# payload is exposed as a memoryview into the mapping so it never has to be copied into Python bytes.
+# Payload views must be released (e.g. by using them as context managers) before the container is closed.
+class AudioContainer:
+    def __init__(self, path):
+        self.path = path
+        extension = os.path.splitext(path)[1]
+        if extension == ".2dx":
+            self.magic_string = b'2DX9'
+            self.format = "wav"
+        elif extension == ".s3p":
+            self.magic_string = b'S3V0'
+            self.format = "wma"
+        else:
+            error("Invalid or nonexistent file type detected, exiting...")
+
+        self.file = open(path, "rb")
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            error(f"Empty audio container {os.path.basename(path)}, exiting...")
+        self.view = memoryview(self.data)
+        self.samples = self._parse_offset_table()
+
+    def _parse_offset_table(self):
+        # get the number of files within the container, and where each one's offset is stored
+        if self.format == "wav":
+            file_count = struct.unpack_from("<I", self.data, 0x14)[0]
+            offsets = struct.unpack_from(f"<{file_count}I", self.data, 0x48)
+        else:
+            file_count = struct.unpack_from("<I", self.data, 0x04)[0]
+            offsets = struct.unpack_from(f"<{file_count * 2}I", self.data, 0x08)[::2]
 
-def get_audio_samples_from_container(song_id, container, volume_multiplier=1):
-    print(f"Looking at file {container} in song id #{song_id}")
+        samples = []
+        for i, offset in enumerate(offsets):
+            # check if each audio sample contained within is valid
+            if self.data[offset:offset + 4] != self.magic_string:
+                if self.format == "wav":
+                    error("Not a valid 2DX audio file, exiting...")
+                else:
+                    error("Not a valid S3V audio file, exiting...")
+
+            # sample header: magic string, header length, payload length
+            (header_size, data_size) = struct.unpack_from("<II", self.data, offset + 4)
+            samples.append(ContainerSample(i, self.format, offset + header_size, data_size))
+        return samples
+
+    def payload(self, index):
+        sample = self.samples[index]
+        return self.view[sample.offset:sample.offset + sample.size]
+
+    def close(self):
+        self.view.release()
+        self.data.close()
+        self.file.close()
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __iter__(self):
+        return iter(self.samples)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Check an audio container by reading only its offset table and sample headers, never the samples themselves.
+# Returns the number of samples and a description of the first problem found (None if there is none).
+def check_audio_container(path):
+    extension = os.path.splitext(path)[1]
+    if extension not in [".2dx", ".s3p"]:
+        return (0, f"{os.path.basename(path)} is not a .2dx or .s3p container.")
+    magic_string = b'2DX9' if extension == ".2dx" else b'S3V0'
+
+    try:
+        with open(path, "rb") as file:
+            file_size = os.fstat(file.fileno()).st_size
+            if extension == ".2dx":
+                file.seek(0x14)
+                file_count = struct.unpack("<I", file.read(4))[0]
+                file.seek(0x48)
+                offsets = struct.unpack(f"<{file_count}I", file.read(4 * file_count))
+            else:
+                file.seek(0x04)
+                file_count = struct.unpack("<I", file.read(4))[0]
+                offsets = struct.unpack(f"<{file_count * 2}I", file.read(8 * file_count))[::2]
+
+            for i, offset in enumerate(offsets):
+                file.seek(offset)
+                (magic, header_size, data_size) = struct.unpack("<4sII", file.read(12))
+                if magic != magic_string:
+                    return (file_count, f"Sample {i} of {os.path.basename(path)} has no {magic_string.decode()} header.")
+                if offset + header_size + data_size > file_size:
+                    return (file_count, f"Sample {i} of {os.path.basename(path)} runs past the end of the file.")
+    except FileNotFoundError:
+        return (0, f"Audio container {os.path.basename(path)} not found.")
+    except struct.error:
+        return (0, f"{os.path.basename(path)} is truncated.")
+    return (file_count, None)
+
+
+# Open an audio container and create its output directory, returning the container along with its id,
+# whether it's a preview container, and the output directory
+def open_audio_container(song_id, container):
+    info("Looking at file %s in song id #%s", container, song_id)
 
     [container_id, container_extension] = os.path.basename(
         container).split(".")
@@ -39,98 +233,259 @@ def get_audio_samples_from_container(song_id, container, volume_multiplier=1):
 
     # initial check if file extension is legit-- actual contents will be checked later
     if container_extension == "2dx":
-        print(".2dx file detected (probably)")
+        info(".2dx file detected (probably)")
     elif container_extension == "s3p":
-        print(".s3p file detected (probably)")
+        info(".s3p file detected (probably)")
     else:
         error("Invalid or nonexistent file type detected, exiting...")
 
-    with open(container, "rb") as infile:
-        print(f"{os.path.basename(infile.name)} loaded successfully.")
+    audio_container = AudioContainer(container)
+    info("%s loaded successfully.", os.path.basename(container))
 
-        # create output directory if it doesn't exist yet
-        output_path = f"{os.path.join('.', 'out', str(song_id), str(container_id))}"
-        if os.path.exists(output_path):
-            print(f"Output path {output_path} already exists, using it.")
+    # create output directory if it doesn't exist yet
+    output_path = f"{os.path.join('.', 'out', str(song_id), str(container_id))}"
+    if os.path.exists(output_path):
+        info("Output path %s already exists, using it.", output_path)
+    else:
+        os.makedirs(output_path, exist_ok=True)
+        info("Output path %s created.", output_path)
+
+    info("%s files detected inside %s.", len(audio_container), os.path.basename(container))
+    return (audio_container, container_id, is_preview_file, output_path)
+
+
+# Work out the sound channel names of all samples in an open container, and the (file, payload) encode jobs
+# for the wanted ones. When not streaming to the encoder, samples are extracted to disk here and have no payload.
+# Silent samples get no encode job, and their sound channels point to the container's silent placeholder instead.
+def plan_container_samples(audio_container, container_id, is_preview_file, output_path, wanted_samples=None,
+                           stream_to_encoder=None, summary=None):
+    if stream_to_encoder is None:
+        stream_to_encoder = STREAM_TO_ENCODER
+
+    # initialize sound channels array for export at the end
+    sound_channels = []
+
+    # iterate over each audio sample in the container
+    sample_jobs = []
+    silent_samples = 0
+    for sample in audio_container:
+        if is_preview_file:
+            filename = f"{os.path.join(output_path, f'preview.{sample.format}')}"
         else:
-            os.makedirs(output_path)
-            print(f"Output path {output_path} created.")
-
-        # get the number of files within the container
-        if container_extension == "2dx":
-            infile.seek(0x14)
-        elif container_extension == "s3p":
-            infile.seek(0x04)
-
-        file_count = struct.unpack("<I", infile.read(4))[0]
-        print(f"{file_count} files detected inside {os.path.basename(infile.name)}.")
-
-        # initialize sound channels array for export at the end
-        sound_channels = []
-
-        # iterate over each audio sample in the container
-        for i in range(file_count):
-            if container_extension == "2dx":
-                infile.seek(0x48 + i * 4)
-            elif container_extension == "s3p":
-                infile.seek(i * 8 + 8)
-            else:
-                error("Invalid or nonexistent file type detected, exiting...")
-
-            offset = struct.unpack("<I", infile.read(4))[0]
-
-            # check if each audio sample contained within is valid
-            infile.seek(offset)
-            magic_string = infile.read(4)
-            if container_extension == "2dx" and magic_string != b'2DX9':
-                error("Not a valid 2DX audio file, exiting...")
-            elif container_extension == "s3p" and magic_string != b'S3V0':
-                error("Not a valid S3V audio file, exiting...")
-
-            # init
-            offset += 4
-            infile.seek(offset)
-            data_offset = struct.unpack("<I", infile.read(4))[0] - 8
-            offset += 4
-            infile.seek(offset)
-            data_size = struct.unpack("<I", infile.read(4))[0]
-
-            # capture and save the audio sample itself
-            offset += data_offset
-            infile.seek(offset)
-            audio_bytes = infile.read(data_size)
-
-            if container_extension == "2dx":
-                audio_extension = "wav"
-            elif container_extension == "s3p":
-                audio_extension = "wma"
-            else:
-                error("Invalid container extension, exiting...")
-
-            if is_preview_file:
-                filename = f"{os.path.join(output_path, f'preview.{audio_extension}')}"
-            else:
-                filename = f"{os.path.join(output_path, f'{i:04d}.{audio_extension}')}"
+            filename = f"{os.path.join(output_path, f'{sample.index:04d}.{sample.format}')}"
+        sound_channels.append(os.path.join(str(container_id), os.path.splitext(os.path.basename(filename))[0] + ".ogg"))
+
+        if wanted_samples is not None and sample.index not in wanted_samples:
+            continue
+
+        if not is_preview_file:
+            with span(summary, "silence scan"), audio_container.payload(sample.index) as payload:
+                silent = is_silent_payload(payload)
+            if silent:
+                trace("%s is silent, using the silent placeholder.", os.path.basename(filename))
+                sound_channels[-1] = os.path.join(str(container_id), SILENT_SAMPLE_FILENAME)
+                silent_samples += 1
+                continue
+
+        if stream_to_encoder:
+            # hand the encoder a view into the mapped container, nothing but the .ogg touches the disk
+            sample_jobs.append((filename, audio_container.payload(sample.index)))
+        elif os.path.exists(filename):
+            trace("Extracted file %s already exists, skipping...", os.path.basename(filename))
+        else:
+            # write straight from the mapped container, without copying the sample into a bytes object
+            with span(summary, "sample extract") as extract_span, \
+                    audio_container.payload(sample.index) as audio_bytes, open(filename, 'wb') as outfile:
+                outfile.write(audio_bytes)
+                extract_span.add_bytes(read=sample.size, written=sample.size)
+
+            trace("%s: %s bytes written.", os.path.basename(filename), sample.size)
+
+    if silent_samples > 0:
+        write_silent_placeholder(output_path)
+        info("%s silent sample(s) skipped.", silent_samples)
+        if summary is not None:
+            summary.add("samples_silent", silent_samples)
+
+    if not stream_to_encoder:
+        info("All audio samples extracted.")
+        sample_jobs = [(os.path.join(output_path, filename), None) for filename in os.listdir(output_path)
+                       if filename.endswith(".wav") or filename.endswith(".wma")]
+
+    return (sound_channels, sample_jobs)
+
+
+# Run an ffmpeg command whose last argument is outfile. ffmpeg writes to a temporary file next to outfile, which
+# only replaces outfile once the encode succeeded: a failed or timed out encode never leaves a partial file behind
+# that later runs would take for a converted one.
+def run_encoder(ffmpeg_command, outfile, input=None):
+    partial_file = os.path.splitext(outfile)[0] + ".partial.ogg"
+    try:
+        subprocess.run(ffmpeg_command[:-1] + [partial_file], input=input, check=True, timeout=ENCODE_TIMEOUT)
+        os.replace(partial_file, outfile)
+    except BaseException:
+        try:
+            os.remove(partial_file)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+silent_placeholder_lock = threading.Lock()
+
+
+# Encode the silent placeholder shared by the silent samples of a container, unless it's already there
+def write_silent_placeholder(output_path):
+    placeholder = os.path.join(output_path, SILENT_SAMPLE_FILENAME)
+    with silent_placeholder_lock:
+        if not os.path.exists(placeholder):
+            # 10ms of digital silence
+            run_encoder(["ffmpeg", "-f", "f32le", "-ar", "44100", "-ac", "2", "-i", "pipe:0", "-c:a", "libvorbis",
+                         "-q:a", str(ENCODE_QUALITY), "-v", "quiet", "-y", placeholder],
+                        placeholder, input=bytes(4 * 2 * 441))
+
+
+# Extract and encode the samples of an audio container, returning the sound channel names of all of its samples.
+# If wanted_samples is given, only those sample indices are encoded and the rest are skipped.
+def get_audio_samples_from_container(song_id, container, volume_multiplier=1, encode_workers=None, stream_to_encoder=None,
+                                     encode_cache=None, wanted_samples=None, summary=None):
+    with span(summary, "container parse"):
+        (audio_container, container_id, is_preview_file, output_path) = open_audio_container(song_id, container)
+    with audio_container:
+        with span(summary, "container parse"):
+            (sound_channels, sample_jobs) = plan_container_samples(audio_container, container_id, is_preview_file,
+                                                                   output_path, wanted_samples, stream_to_encoder,
+                                                                   summary)
+
+        # encode all samples at once on a bounded pool of ffmpeg processes
+        failed_samples = []
+        with ThreadPoolExecutor(max_workers=encode_workers or ENCODE_WORKERS) as encode_pool:
+            futures = {encode_pool.submit(convert_to_ogg_file, sample_file, song_id, volume_multiplier, payload,
+                                          encode_cache, summary): sample_file
+                       for sample_file, payload in sample_jobs}
+            del sample_jobs
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError) as e:
+                    warning("Failed to convert %s: %s", os.path.basename(futures[future]), e, summary=summary)
+                    failed_samples.append(os.path.basename(futures[future]))
+
+        if encode_cache is not None:
+            encode_cache.evict()
+
+        if failed_samples:
+            error(f"{len(failed_samples)} audio sample(s) from {os.path.basename(container)} failed to convert: {', '.join(sorted(failed_samples))}")
+
+        info("%s of %s sound channels exported.", len(futures), len(sound_channels))
+        return sound_channels
 
-            if os.path.exists(filename):
-                print(f"Extracted file {os.path.basename(filename)} already exists, skipping...")
-            else:
-                with open(filename, 'wb') as outfile:
-                    outfile.write(audio_bytes)
 
-                print(f"{os.path.basename(filename)}: {len(audio_bytes)} bytes written.")
+# the encode cache at ENCODE_CACHE_DIR, shared by every song converted in this process so its size is only looked up
+# once, created the first time it's needed
+default_encode_cache = None
+default_encode_cache_lock = threading.Lock()
+
+
+def get_default_encode_cache():
+    global default_encode_cache
+    with default_encode_cache_lock:
+        if default_encode_cache is None:
+            default_encode_cache = EncodeCache(ENCODE_CACHE_DIR, ENCODE_CACHE_SIZE)
+    return default_encode_cache
+
+
+# Per-song memo of container work: each container (including alternate containers) is extracted and
+# encoded once, and every chart of the song reuses the resulting sample list
+class ContainerSession:
+    def __init__(self, song_id, encode_workers=None, encode_cache=None, manifest=None, summary=None):
+        self.song_id = song_id
+        self.encode_workers = encode_workers
+        self.manifest = manifest
+        self.summary = summary
+        if encode_cache is None and ENCODE_CACHE_DIR is not None:
+            encode_cache = get_default_encode_cache()
+        self.encode_cache = encode_cache
+        self.sample_lists = {}
+        self.sample_locks = {}
+        self.wanted_samples = {}
+        self.sample_pool = DecodedSamplePool(summary=summary)
+        self.bgm_tracks = {}
+        self.bgm_locks = {}
+        self.lock = threading.Lock()
+
+    # restrict which samples get encoded for a container; samples wanted by any chart are encoded
+    def add_wanted_samples(self, container, samples):
+        self.wanted_samples.setdefault(os.path.abspath(container), set()).update(samples)
+
+    # charts whose background tracks have the same fingerprint share a single rendered track
+    def get_bgm(self, bgm_samples, dir_index, container):
+        fingerprint = get_bgm_fingerprint(bgm_samples, container)
+        # charts rendered at the same time wait for whichever one renders their shared track first
+        with self.lock:
+            bgm_lock = self.bgm_locks.setdefault(fingerprint, threading.Lock())
+        with bgm_lock:
+            return self._get_bgm(bgm_samples, dir_index, fingerprint)
+
+    def _get_bgm(self, bgm_samples, dir_index, fingerprint):
+        if fingerprint in self.bgm_tracks:
+            info("Background track is identical to %s, reusing it.", os.path.basename(self.bgm_tracks[fingerprint]))
+            return self.bgm_tracks[fingerprint]
+
+        if self.manifest is not None:
+            # a track left over from a previous run is only reused if it was rendered from the same events
+            (output_folder, filename) = get_bgm_filename(bgm_samples, dir_index)
+            bgm_output_location = os.path.join(".", "out", str(self.song_id), output_folder, filename)
+            if not self.manifest.is_fresh(f"bgm:{filename}", fingerprint) and os.path.exists(bgm_output_location):
+                os.remove(bgm_output_location)
+        self.bgm_tracks[fingerprint] = generate_bgm(bgm_samples, self.song_id, dir_index, self.sample_pool, self.summary)
+        if self.summary is not None:
+            self.summary.add("bgm_tracks")
+        if self.manifest is not None:
+            self.manifest.record(f"bgm:{os.path.basename(self.bgm_tracks[fingerprint])}", fingerprint)
+        return self.bgm_tracks[fingerprint]
+
+    # Open a container and plan its encodes without running them, so they can be scheduled as separate tasks.
+    # Later get_audio_samples calls for the container return its sample list straight away.
+    def plan_audio_samples(self, container, volume_multiplier=1):
+        key = (os.path.abspath(container), volume_multiplier)
+        with span(self.summary, "container parse"):
+            (audio_container, container_id, is_preview_file, output_path) = open_audio_container(self.song_id, container)
+            (self.sample_lists[key], sample_jobs) = plan_container_samples(audio_container, container_id, is_preview_file,
+                                                                           output_path, self.wanted_samples.get(key[0]),
+                                                                           summary=self.summary)
+        return (audio_container, sample_jobs)
+
+    def get_audio_samples(self, container, volume_multiplier=1):
+        key = (os.path.abspath(container), volume_multiplier)
+        with self.lock:
+            sample_lock = self.sample_locks.setdefault(key, threading.Lock())
+        with sample_lock:
+            return self._get_audio_samples(container, volume_multiplier, key)
+
+    def _get_audio_samples(self, container, volume_multiplier, key):
+        if key in self.sample_lists:
+            info("Reusing audio samples from %s.", os.path.basename(container))
+        else:
+            self.sample_lists[key] = get_audio_samples_from_container(self.song_id, container, volume_multiplier,
+                                                                        self.encode_workers, encode_cache=self.encode_cache,
+                                                                        wanted_samples=self.wanted_samples.get(key[0]),
+                                                                        summary=self.summary)
+        return self.sample_lists[key]
 
-        print("All audio samples extracted.")
-        for filename in os.listdir(output_path):
-            if filename.endswith(".wav") or filename.endswith(".wma"):
-                sound_channels.append(convert_to_ogg_file(os.path.join(output_path, filename), song_id, volume_multiplier))
 
-        sound_channels.sort()
-        print("All sound channels exported.")
-        return sound_channels
+# Convert an extracted sample to .ogg. If the sample's payload is given, it's piped straight into ffmpeg
+# and infile (which was never written) only determines the output name.
+def convert_to_ogg_file(infile, song_id, volume_multiplier, payload=None, encode_cache=None, summary=None):
+    # the payload has to be released whatever happens, or its container can't be closed
+    try:
+        return _convert_to_ogg_file(infile, song_id, volume_multiplier, payload, encode_cache, summary)
+    finally:
+        if payload is not None:
+            payload.release()
 
 
-def convert_to_ogg_file(infile, song_id, volume_multiplier):
+def _convert_to_ogg_file(infile, song_id, volume_multiplier, payload, encode_cache, summary):
     outfile = os.path.splitext(infile)[0] + ".ogg"
     
     # Figure out whether to cut out the silence of converted audio files
@@ -141,89 +496,205 @@ def convert_to_ogg_file(infile, song_id, volume_multiplier):
 
     # the actual conversion happens here
     if os.path.exists(outfile):
-        print(
-            f"Converted file {os.path.basename(outfile)} already exists, skipping...")
+        trace("Converted file %s already exists, skipping...", os.path.basename(outfile))
     else:
-        print(f"Converting to {os.path.basename(outfile)}...")
-        
-        ffmpeg_command = ["ffmpeg", "-i", infile, "-filter:a", f"volume={volume_multiplier}", "-c:a", "libvorbis", "-q:a", "9", "-shortest"]
-        if should_be_trimmed:
-            ffmpeg_command = ffmpeg_command + ["-af", "atrim=start=0.0925"]
-        ffmpeg_command = ffmpeg_command + ["-vn", "-v", "quiet", "-y", outfile]
-        subprocess.run(ffmpeg_command, check=True)
-
-        # if is_silent(outfile):
-
-    
-    os.remove(infile)
+        # identical samples encoded with the same parameters are only encoded once
+        cache_key = None
+        cache_hit = False
+        if encode_cache is not None:
+            with span(summary, "encode cache"):
+                cache_key = encode_cache.key(infile if payload is None else payload,
+                                             volume_multiplier, should_be_trimmed, ENCODE_QUALITY)
+                cache_hit = encode_cache.fetch(cache_key, outfile)
+
+        if cache_hit:
+            trace("Found %s in the encode cache.", os.path.basename(outfile))
+            if summary is not None:
+                summary.add("samples_cached")
+        else:
+            trace("Converting to %s...", os.path.basename(outfile))
+
+            ffmpeg_command = ["ffmpeg", "-i", infile if payload is None else "pipe:0", "-filter:a", f"volume={volume_multiplier}", "-c:a", "libvorbis", "-q:a", str(ENCODE_QUALITY), "-shortest"]
+            if should_be_trimmed:
+                ffmpeg_command = ffmpeg_command + ["-af", "atrim=start=0.0925"]
+            ffmpeg_command = ffmpeg_command + ["-vn", "-v", "quiet", "-y", outfile]
+            with span(summary, "encode") as encode_span:
+                if payload is None:
+                    encode_span.add_bytes(read=os.path.getsize(infile))
+                    run_encoder(ffmpeg_command, outfile)
+                else:
+                    encode_span.add_bytes(read=payload.nbytes)
+                    with payload:
+                        run_encoder(ffmpeg_command, outfile, input=payload)
+                encode_span.add_bytes(written=os.path.getsize(outfile))
+
+            if cache_key is not None:
+                with span(summary, "encode cache"):
+                    encode_cache.store(cache_key, outfile)
+            if summary is not None:
+                summary.add("samples_encoded")
+
+    if payload is None:
+        os.remove(infile)
 
     return os.path.join(os.path.abspath(outfile).split(os.path.sep)[-2], os.path.abspath(outfile).split(os.path.sep)[-1])
 
 
-# given a list of audio samples and their offsets, output a single audio file containing all merged background samples played at the correct time
-def generate_bgm(bgm_samples, song_id, dir_index):
+# Per-song pool of decoded samples as 44.1 kHz stereo buffers, so each sample is decoded once no matter how often
+# (or in how many charts) it's placed. Least recently used buffers are dropped once the pool grows past max_bytes,
+# but their lengths are remembered. Charts rendered at the same time wait for whichever one decodes a shared
+# sample first instead of decoding it again.
+class DecodedSamplePool:
+    def __init__(self, max_bytes=None, summary=None, mixer=None):
+        self.max_bytes = DECODED_POOL_SIZE if max_bytes is None else max_bytes
+        self.summary = summary
+        self.mixer = mixer or get_mixer(MIXER_BACKEND)
+        self.buffers = OrderedDict()
+        self.lengths = {}
+        self.total_bytes = 0
+        self.file_locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, file):
+        with self.lock:
+            if file in self.buffers:
+                self.buffers.move_to_end(file)
+                return self.buffers[file]
+            file_lock = self.file_locks.setdefault(file, threading.Lock())
+        with file_lock:
+            return self._get(file)
+
+    def _get(self, file):
+        with self.lock:
+            if file in self.buffers:
+                self.buffers.move_to_end(file)
+                return self.buffers[file]
+
+        with span(self.summary, "bgm load") as load_span:
+            load_span.add_bytes(read=os.path.getsize(file))
+            (signal, sample_rate) = self.mixer.load(file)
+        if sample_rate != 44100:
+            with span(self.summary, "bgm resample"):
+                signal = self.mixer.resample(signal, sample_rate)
+        signal = self.mixer.to_stereo(signal)
+
+        with self.lock:
+            if file not in self.buffers:
+                self.buffers[file] = signal
+                self.lengths[file] = signal.shape[1]
+                self.total_bytes += self.mixer.nbytes(signal)
+                while self.total_bytes > self.max_bytes and len(self.buffers) > 1:
+                    (_, evicted_signal) = self.buffers.popitem(last=False)
+                    self.total_bytes -= self.mixer.nbytes(evicted_signal)
+        return signal
+
+    def length(self, file):
+        if file not in self.lengths:
+            self.get(file)
+        return self.lengths[file]
+
+
+# Mix background samples placed at (start sample, file) into consecutive blocks of block_size samples.
+# Placements must be sorted by start; only the samples overlapping a block are touched while mixing it,
+# so memory use depends on the block size and how many samples overlap, not on the length of the song.
+# Every block is mixed into the same preallocated buffer, so each one must be used up before the next is mixed.
+def mix_bgm_blocks(placements, total_length, sample_pool, block_size=None):
+    block_size = block_size or BGM_BLOCK_SIZE
+    buffer = sample_pool.mixer.zeros(min(block_size, total_length))
+    active_placements = []
+    next_placement = 0
+    for block_start in range(0, total_length, block_size):
+        block_end = min(block_start + block_size, total_length)
+        while next_placement < len(placements) and placements[next_placement][0] < block_end:
+            active_placements.append(placements[next_placement])
+            next_placement += 1
+
+        block = buffer[:, :block_end - block_start]
+        block[:, :] = 0
+        still_active = []
+        for start_sample, file in active_placements:
+            signal = sample_pool.get(file)
+            end_sample = start_sample + signal.shape[1]
+            mix_start = max(start_sample, block_start)
+            mix_end = min(end_sample, block_end)
+            if mix_end > mix_start:
+                block[:, mix_start - block_start:mix_end - block_start] += \
+                    signal[:, mix_start - start_sample:mix_end - start_sample]
+            if end_sample > block_end:
+                still_active.append((start_sample, file))
+        active_placements = still_active
+        yield block
+
+
+# Identify a background track by the container its samples come from and its resolved (offset, sample) events
+def get_bgm_fingerprint(bgm_samples, container):
+    fingerprint = hashlib.sha256(os.path.abspath(container).encode())
+    for offset, file in bgm_samples:
+        fingerprint.update(f"{offset}:{file};".encode())
+    return fingerprint.hexdigest()
+
+
+# Determine the background track's output folder and file name from its samples and chart directory entry
+def get_bgm_filename(bgm_samples, dir_index):
     output_folder = bgm_samples[0][1].split(os.path.sep)[0]
 
     # Determine file name from chart directory entry
-    filename = f"{output_folder}-BGM-"
-    match dir_index:
-        case 0:
-            filename += "SP-H"
-        case 1:
-            filename += "SP-N"
-        case 2:
-            filename += "SP-A"
-        case 3:
-            filename += "SP-B"
-        case 4:
-            filename += "SP-L"
-        case 6:
-            filename += "DP-H"
-        case 7:
-            filename += "DP-N"
-        case 8:
-            filename += "DP-A"
-        case 9:
-            filename += "DP-B"
-        case 10:
-            filename += "DP-L"
-        case _:
-            error("Invalid directory index, exiting...")
-
-    filename += ".ogg"
+    if str(dir_index) not in chart_names:
+        error("Invalid directory index, exiting...")
+    filename = f"{output_folder}-BGM-{chart_names[str(dir_index)]}.ogg"
+    return (output_folder, filename)
+
+
+# given a list of audio samples and their offsets, output a single audio file containing all merged background samples played at the correct time
+def generate_bgm(bgm_samples, song_id, dir_index, sample_pool=None, summary=None):
+    (output_folder, filename) = get_bgm_filename(bgm_samples, dir_index)
     bgm_output_location = os.path.join(".", "out", str(song_id),
                                        output_folder, filename)
 
-    if os.path.exists(filename):
-        print(f"File {os.path.basename(filename)} already exists, skipping.")
-    else:
-        max_length = 0
-        for offset, file in bgm_samples:
-            print(
-                f"Torchaudio: Placing file {os.path.basename(file)} at offset {offset}ms.")
-            file = os.path.join(".", "out", str(song_id), file)
-            signal, sample_rate = torchaudio.load(file)
-            signal_length = int(
-                signal.shape[1] * 44100 / sample_rate + offset * 44100 / 1000)
-            if signal_length > max_length:
-                max_length = signal_length
-        print("Torchaudio: Initial pass complete.")
-        output_signal = torch.zeros(2, max_length)
+    if sample_pool is None:
+        sample_pool = DecodedSamplePool()
 
+    if os.path.exists(bgm_output_location):
+        info("File %s already exists, skipping.", os.path.basename(filename))
+    else:
+        # sort background samples by where they start, so each block only touches the samples active in it
+        placements = []
         for offset, file in bgm_samples:
+            # silent samples wouldn't add anything to the mix
+            if os.path.basename(file) == SILENT_SAMPLE_FILENAME:
+                continue
+            trace("Mixer: Placing file %s at offset %sms.", os.path.basename(file), offset)
             file = os.path.join(".", "out", str(song_id), file)
-            print(
-                f"Torchaudio: Merging file {os.path.basename(file)} at offset {offset}ms.")
-            signal, sample_rate = torchaudio.load(file)
-            signal = torchaudio.transforms.Resample(sample_rate, 44100)(signal)
-            if signal.shape[0] == 1:
-                signal = torch.cat((signal, signal), dim=0)
-            start_sample = int(offset * 44100 / 1000)
-            end_sample = start_sample + signal.shape[1]
-            output_signal[:, start_sample:end_sample] += signal
-        print("Torchaudio: Final pass complete.")
-        print(f"Saving to file {os.path.basename(filename)}...")
-        torchaudio.save(bgm_output_location, output_signal, 44100, True, 9, "ogg")
-        print(f"File {os.path.basename(filename)} saved.")
+            placements.append((int(offset * 44100 / 1000), file))
+        placements.sort(key=lambda placement: placement[0])
+        max_length = max((start_sample + sample_pool.length(file) for start_sample, file in placements), default=1)
+        info("Mixer (%s): Initial pass complete.", sample_pool.mixer.name)
+
+        # mix block by block, handing each finished block straight to the encoder
+        info("Saving to file %s...", os.path.basename(filename))
+        encoder = subprocess.Popen(["ffmpeg", "-f", "f32le", "-ar", "44100", "-ac", "2", "-i", "pipe:0",
+                                    "-c:a", "libvorbis", "-q:a", str(ENCODE_QUALITY), "-v", "quiet", "-y", bgm_output_location],
+                                   stdin=subprocess.PIPE)
+        try:
+            blocks = mix_bgm_blocks(placements, max_length, sample_pool)
+            while True:
+                with span(summary, "bgm mix"):
+                    block = next(blocks, None)
+                if block is None:
+                    break
+                with span(summary, "bgm encode") as encode_span:
+                    block_bytes = sample_pool.mixer.to_pcm_bytes(block)
+                    encoder.stdin.write(block_bytes)
+                    encode_span.add_bytes(read=len(block_bytes))
+        finally:
+            with span(summary, "bgm encode") as encode_span:
+                encoder.stdin.close()
+                encoder.wait()
+                if os.path.exists(bgm_output_location):
+                    encode_span.add_bytes(written=os.path.getsize(bgm_output_location))
+        if encoder.returncode != 0:
+            error(f"Failed to encode {os.path.basename(filename)}, exiting...")
+        info("Mixer (%s): Final pass complete.", sample_pool.mixer.name)
+        info("File %s saved.", os.path.basename(filename))
 
     return os.path.join(str(output_folder), filename)
\ No newline at end of file
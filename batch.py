@@ -0,0 +1,222 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from index import INDEX_FILENAME, SongIndex
+from instrumentation import format_phase_table, get_run_report
+from utils import *
+from Misc_enums import *
+
+JOB_LOG_FILENAME = "elpis-jobs.jsonl"
+
+
+# The music database is a JSON file of db entries, either keyed by song id or as a list of entries with a "song_id"
+def load_music_database(path):
+    with open(path, "r", encoding="utf-8") as file:
+        music_database = json.load(file)
+    if isinstance(music_database, list):
+        music_database = {str(db_entry["song_id"]): db_entry for db_entry in music_database}
+    return {str(song_id).zfill(5): db_entry for song_id, db_entry in music_database.items()}
+
+
+# Read the job log, keeping only the latest record for each song
+def read_job_log(path):
+    records = {}
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a run that was killed mid-write can leave a partial last line behind
+                    continue
+                records[record["song_id"]] = record
+    return records
+
+
+def append_job_log(path, record):
+    append_json_line(path, record)
+
+
+def find_sound_path(contents_dir, song_id):
+    for sound_path in [os.path.join(contents_dir, "data", "sound", song_id),
+                       os.path.join(contents_dir, "data", "sound", f"{song_id}_ifs", song_id)]:
+        if os.path.exists(sound_path):
+            return sound_path
+    return None
+
+
+# Convert a single song inside a worker process, turning any failure into a job log record.
+# Returns the record along with the song's summary (None if it failed).
+def convert_song(contents_dir, song_id, db_entry, encode_workers, task_workers=None, summary_log=None, log_level="info",
+                 profile_path=None):
+    from elpis import parse_all_charts_and_audio
+
+    setup_logging(log_level)
+    start_time = time.time()
+    record = {"song_id": song_id, "status": "ok"}
+    summary = None
+    try:
+        summary = parse_all_charts_and_audio(contents_dir, song_id, db_entry, encode_workers, task_workers=task_workers,
+                                             summary_log=summary_log, profile_path=profile_path)
+    except ConversionError as e:
+        record = {"song_id": song_id, "status": "failed", "reason": str(e)}
+    except Exception as e:
+        record = {"song_id": song_id, "status": "failed", "reason": f"{type(e).__name__}: {e}"}
+    record["seconds"] = round(time.time() - start_time, 3)
+    return (record, summary)
+
+
+# Convert every song in the music database, spread over a pool of worker processes. Every song's outcome is
+# appended to the job log, and songs already logged as converted or skipped are left alone, so an interrupted
+# run picks up where it left off. At the end, the time spent in each phase of the converted songs is reported,
+# and saved to report_path as JSON if given. If profile_song is given, that song is converted under cProfile.
+# With a song_index, sound directories are looked up in the index instead of on disk, converted songs are marked
+# in it, and only the songs in song_ids (if given) are converted. Without resume, the job log isn't consulted.
+# With preflight, every song's charts and containers are checked before anything is converted, and songs with
+# problems are logged as failed instead of being converted; with preflight_only, the check is all that's done.
+def run_batch(contents_dir, music_database, job_log_path=JOB_LOG_FILENAME, workers=None, encode_workers=None,
+              retry_failed=True, task_workers=None, summary_log=None, log_level="info", report_path=None,
+              profile_song=None, song_index=None, song_ids=None, resume=True, preflight=False, preflight_only=False):
+    workers = workers or os.cpu_count() or 1
+
+    finished_statuses = ["ok", "skipped"] if retry_failed else ["ok", "skipped", "failed"]
+    previous_records = read_job_log(job_log_path)
+    candidate_song_ids = sorted(music_database) if song_ids is None else song_ids
+    song_ids = []
+    sound_paths = {}
+    for song_id in candidate_song_ids:
+        if resume and song_id in previous_records and previous_records[song_id]["status"] in finished_statuses:
+            continue
+        if song_index is not None:
+            sound_path = song_index.get_sound_path(song_id)
+        else:
+            sound_path = find_sound_path(contents_dir, song_id)
+        if sound_path is None:
+            append_job_log(job_log_path, {"song_id": song_id, "status": "skipped", "reason": "No sound directory found."})
+            continue
+        song_ids.append(song_id)
+        sound_paths[song_id] = sound_path
+
+    info("%s song(s) to convert, %s already done or skipped.", len(song_ids), len(candidate_song_ids) - len(song_ids))
+    counts = {"ok": 0, "failed": 0}
+
+    if preflight or preflight_only:
+        from preflight import preflight_songs
+
+        bad_songs = preflight_songs(music_database, sound_paths)
+        if preflight_only:
+            counts["failed"] = len(bad_songs)
+            return counts
+        for song_id, problems in bad_songs.items():
+            append_job_log(job_log_path, {"song_id": song_id, "status": "failed", "reason": "Preflight: " + " ".join(problems)})
+            counts["failed"] += 1
+        song_ids = [song_id for song_id in song_ids if song_id not in bad_songs]
+
+    # share the cores between the songs actually being converted instead of letting every song start one ffmpeg
+    # per core. A song converted on its own gets them all.
+    workers = max(1, min(workers, len(song_ids)))
+    encode_workers = encode_workers or max(1, (os.cpu_count() or 1) // workers)
+
+    summaries = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(convert_song, contents_dir, song_id, music_database[song_id], encode_workers,
+                               task_workers, summary_log, log_level,
+                               f"elpis-{song_id}.prof" if song_id == profile_song else None): song_id
+                   for song_id in song_ids}
+        for future in as_completed(futures):
+            try:
+                (record, summary) = future.result()
+                if summary is not None:
+                    summaries.append(summary)
+            except Exception as e:
+                # the worker process itself died
+                record = {"song_id": futures[future], "status": "failed", "reason": f"{type(e).__name__}: {e}"}
+            append_job_log(job_log_path, record)
+            counts[record["status"]] += 1
+            if record["status"] == "ok":
+                if song_index is not None:
+                    song_index.mark_converted(record["song_id"])
+                success(f"Song #{record['song_id']} converted.")
+            else:
+                warning(f"Song #{record['song_id']} failed: {record['reason']}")
+
+    info("Batch finished: %s converted, %s failed.", counts["ok"], counts["failed"])
+    report = get_run_report(summaries)
+    if summaries:
+        info("Time spent per phase (peak RSS %s KiB, ffmpeg CPU %ss):\n%s", report["peak_rss_kb"], report["child_cpu"],
+             format_phase_table(report["phases"]))
+    if report_path is not None:
+        with open(report_path, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=1)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a whole beatmania IIDX library to bmson.")
+    parser.add_argument("contents_dir", help="game contents directory (containing data/sound)")
+    parser.add_argument("music_database", help="JSON file of db entries by song id")
+    parser.add_argument("--job-log", default=JOB_LOG_FILENAME, help="append-only job log used to resume runs")
+    parser.add_argument("--workers", type=int, default=None, help="number of songs converted at once")
+    parser.add_argument("--encode-workers", type=int, default=None, help="number of ffmpeg encodes per song")
+    parser.add_argument("--task-workers", type=int, default=None,
+                        help="convert each song's charts concurrently, as a task graph on this many threads "
+                             "(default: off)")
+    parser.add_argument("--preflight", action="store_true",
+                        help="check every song's charts and container headers first, and skip the songs with problems")
+    parser.add_argument("--preflight-only", action="store_true", help="only run the preflight check, converting nothing")
+    parser.add_argument("--no-retry-failed", action="store_true", help="don't retry songs that failed last time")
+    parser.add_argument("--summary-log", default=None, help="append a JSON-lines summary of every converted song here")
+    parser.add_argument("--report", default=None, help="save a JSON report of the time spent per phase here")
+    parser.add_argument("--profile", default=None, metavar="SONG_ID",
+                        help="convert this song under cProfile, saving the stats to elpis-<song id>.prof")
+    parser.add_argument("--song", action="append", default=None, metavar="SONG_ID",
+                        help="only convert this song (can be given several times)")
+    parser.add_argument("--index", nargs="?", const=INDEX_FILENAME, default=None,
+                        help=f"plan the run with a SQLite song index, rebuilt at the start (default file: {INDEX_FILENAME})")
+    parser.add_argument("--chart", default=None, choices=list(chart_names.values()),
+                        help="only convert songs with this chart (needs --index)")
+    parser.add_argument("--changed-only", action="store_true",
+                        help="only convert songs whose inputs changed since their last conversion (needs --index)")
+    parser.add_argument("--log-level", default="info", choices=["trace", "debug", "info", "warning", "error"],
+                        help="trace also logs every chart event and sample")
+    args = parser.parse_args()
+    if (args.chart is not None or args.changed_only) and args.index is None:
+        parser.error("--chart and --changed-only need --index")
+    setup_logging(args.log_level)
+
+    music_database = load_music_database(args.music_database)
+    song_index = None
+    song_ids = None
+    if args.index is not None:
+        from elpis import get_alt_containers
+
+        song_index = SongIndex(args.index)
+        song_index.build(args.contents_dir, music_database, get_alt_containers())
+        song_ids = song_index.find_songs(args.chart, args.changed_only)
+        if args.changed_only:
+            info("%s song(s) changed since their last conversion.", len(song_ids))
+    if args.song is not None:
+        selected_song_ids = [song_id.zfill(5) for song_id in args.song]
+        for song_id in selected_song_ids:
+            if song_id not in music_database:
+                parser.error(f"song {song_id} is not in the music database")
+        song_ids = [song_id for song_id in (song_ids if song_ids is not None else selected_song_ids)
+                    if song_id in selected_song_ids]
+
+    try:
+        run_batch(args.contents_dir, music_database, args.job_log, args.workers, args.encode_workers,
+                  not args.no_retry_failed, args.task_workers, args.summary_log, args.log_level, args.report,
+                  args.profile.zfill(5) if args.profile else None, song_index, song_ids,
+                  # a song converted earlier may have changed since, the index knows which ones are done;
+                  # songs asked for by id are converted again either way (unchanged charts are skipped anyway)
+                  resume=not args.changed_only and args.song is None, preflight=args.preflight, preflight_only=args.preflight_only)
+    finally:
+        if song_index is not None:
+            song_index.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+import argparse
+import importlib.util
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import fixtures
+from utils import *
+
+BASELINE_FILENAME = "bench-baselines.json"
+# a benchmark regresses when its median time grows by more than this fraction over its baseline
+REGRESSION_TOLERANCE = 0.15
+# quick benchmarks are run several times per measurement, so each measurement takes at least this long
+MIN_MEASUREMENT_TIME = 0.2
+# how long importing the converter in a fresh process may take, in seconds, whatever the baselines say
+IMPORT_TIME_BUDGET = 0.5
+# modules that must only be imported once a phase actually needs them
+LAZY_MODULES = ["torch", "torchaudio", "pydub"]
+# the NumPy mixing backend has to match the torch one within this much, in full scale float samples
+MIXER_TOLERANCE = 1e-4
+# sample rates of the fixtures both mixing backends are checked on
+MIXER_CHECK_SAMPLE_RATES = [22050, 32000, 48000]
+
+
+# Benchmarks of the converter's hot paths on synthetic fixtures. Each benchmark is a setup function, run once,
+# that returns the function to time; the timed function is measured repeat times and its median time per call
+# is compared against the saved baseline.
+
+
+# Import the converter in a fresh process, the way every batch worker and CLI invocation starts
+def bench_import(work_dir, scale):
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    environment = os.environ | {"PYTHONPATH": os.pathsep.join([repo_dir, os.environ.get("PYTHONPATH", "")])}
+    check_lazy_modules = f"import sys, elpis, batch; sys.exit(any(module in sys.modules for module in {LAZY_MODULES!r}))"
+
+    def run():
+        if subprocess.run([sys.executable, "-c", check_lazy_modules], env=environment).returncode != 0:
+            error(f"Importing elpis also imported one of {', '.join(LAZY_MODULES)}, which should be imported lazily.")
+    return run
+
+
+def bench_chart_decode(work_dir, scale):
+    from elpis import decode_chart, get_referenced_samples
+
+    chart_data = bytes(96) + fixtures.generate_chart(20000 * scale, seed=1)
+
+    def run():
+        decode_chart(chart_data, 96)
+        get_referenced_samples(chart_data, 96)
+    return run
+
+
+def bench_convert_to_pulses(work_dir, scale):
+    rng = np.random.default_rng(2)
+    tempo_changes = [[0, 150]] + [[int(offset), int(bpm)] for offset, bpm in
+                                  zip(np.sort(rng.integers(1, 120000, 200)), rng.integers(60, 400, 200))]
+    offsets = np.sort(rng.integers(0, 120000, 20000 * scale))
+
+    def run():
+        tempo_map = TempoMap(tempo_changes)
+        tempo_map.pulses_many(offsets)
+        tempo_map.lengths_many(offsets, np.full(len(offsets), 250))
+    return run
+
+
+# the single-lookup path, which every conversion used to go through
+def bench_convert_to_pulses_scalar(work_dir, scale):
+    rng = np.random.default_rng(2)
+    tempo_changes = [[0, 150]] + [[int(offset), int(bpm)] for offset, bpm in
+                                  zip(np.sort(rng.integers(1, 120000, 200)), rng.integers(60, 400, 200))]
+    offsets = np.sort(rng.integers(0, 120000, 2000 * scale)).tolist()
+
+    def run():
+        for offset in offsets:
+            convert_to_pulses(offset, tempo_changes)
+    return run
+
+
+def bench_container_extraction(work_dir, scale):
+    from audio import open_audio_container, plan_container_samples
+
+    container = os.path.join(work_dir, "90001.2dx")
+    fixtures.write_2dx(container, fixtures.generate_payloads(64 * scale, 500))
+
+    def run():
+        (audio_container, container_id, is_preview_file, output_path) = open_audio_container("90001", container)
+        with audio_container:
+            shutil.rmtree(output_path)
+            os.makedirs(output_path)
+            plan_container_samples(audio_container, container_id, is_preview_file, output_path, stream_to_encoder=False)
+    return run
+
+
+def bench_bgm_mixing(work_dir, scale):
+    from audio import DecodedSamplePool, mix_bgm_blocks
+
+    files = []
+    for i, payload in enumerate(fixtures.generate_payloads(32, 500)):
+        files.append(os.path.join(work_dir, f"{i:04d}.wav"))
+        with open(files[-1], "wb") as file:
+            file.write(payload)
+    placements = sorted((i * 44100 // 8, files[i % len(files)]) for i in range(400 * scale))
+
+    def run():
+        sample_pool = DecodedSamplePool()
+        total_length = max(start_sample + sample_pool.length(file) for start_sample, file in placements)
+        for _ in mix_bgm_blocks(placements, total_length, sample_pool):
+            pass
+    return run
+
+
+def bench_full_song(work_dir, scale):
+    from elpis import parse_all_charts_and_audio
+
+    db_entry = fixtures.generate_song("contents", "90002", event_count=2000 * scale, sample_count=32 * scale)
+
+    def run():
+        shutil.rmtree("out", ignore_errors=True)
+        shutil.rmtree("cache", ignore_errors=True)
+        parse_all_charts_and_audio("contents", "90002", db_entry)
+    return run
+
+
+BENCHMARKS = {
+    "import": bench_import,
+    "chart decode": bench_chart_decode,
+    "convert_to_pulses": bench_convert_to_pulses,
+    "convert_to_pulses (scalar)": bench_convert_to_pulses_scalar,
+    "container extraction": bench_container_extraction,
+    "bgm mixing": bench_bgm_mixing,
+    "full song": bench_full_song
+}
+
+
+# Run benchmarks in a scratch directory, returning the median and fastest time of each in seconds
+def run_benchmarks(names=None, repeat=5, scale=1):
+    # the benchmarks run in scratch directories, so load ALT_CONTAINER_FILE from this one first
+    import elpis
+    elpis.get_alt_containers()
+
+    results = {}
+    original_dir = os.getcwd()
+    for name in names or BENCHMARKS:
+        work_dir = tempfile.mkdtemp(prefix="elpis-bench-")
+        os.chdir(work_dir)
+        try:
+            run = BENCHMARKS[name](work_dir, scale)
+            # the first call doubles as a warm-up and decides how many calls go into each measurement
+            start_time = time.perf_counter()
+            run()
+            number = max(1, int(MIN_MEASUREMENT_TIME / max(time.perf_counter() - start_time, 1e-9)))
+
+            timings = []
+            for _ in range(repeat):
+                start_time = time.perf_counter()
+                for _ in range(number):
+                    run()
+                timings.append((time.perf_counter() - start_time) / number)
+            results[name] = {"median": statistics.median(timings), "min": min(timings)}
+        finally:
+            os.chdir(original_dir)
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+# Mix the same mono and stereo fixtures at each of MIXER_CHECK_SAMPLE_RATES to 44.1 kHz with both mixing backends,
+# returning the largest absolute difference between the two mixes, or None when torch isn't installed
+def compare_mixers():
+    if importlib.util.find_spec("torch") is None or importlib.util.find_spec("torchaudio") is None:
+        return None
+    from audio import DecodedSamplePool, mix_bgm_blocks
+    from mixer import NumpyMixer, TorchMixer
+
+    work_dir = tempfile.mkdtemp(prefix="elpis-bench-")
+    try:
+        files = []
+        for sample_rate in MIXER_CHECK_SAMPLE_RATES:
+            for channels in [1, 2]:
+                files.append(os.path.join(work_dir, f"{sample_rate}-{channels}.wav"))
+                with open(files[-1], "wb") as file:
+                    file.write(fixtures.generate_pcm(250, sample_rate, channels, frequency=330.0 * channels,
+                                                     seed=sample_rate + channels))
+        # overlapping placements, so differences add up the way they would in a real mix
+        placements = sorted((i * 44100 // 16, files[i % len(files)]) for i in range(48))
+
+        mixes = []
+        for mixer in [NumpyMixer(), TorchMixer()]:
+            sample_pool = DecodedSamplePool(mixer=mixer)
+            total_length = max(start_sample + sample_pool.length(file) for start_sample, file in placements)
+            mixes.append(np.concatenate([np.frombuffer(mixer.to_pcm_bytes(block), dtype="<f4")
+                                         for block in mix_bgm_blocks(placements, total_length, sample_pool)]))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if len(mixes[0]) != len(mixes[1]):
+        error(f"The numpy and torch mixers produced mixes of {len(mixes[0])} and {len(mixes[1])} samples.")
+    return float(np.max(np.abs(mixes[0] - mixes[1])))
+
+
+# Compare results with the baselines, returning the names of the benchmarks that regressed
+def find_regressions(results, baselines, tolerance=REGRESSION_TOLERANCE):
+    regressions = []
+    for name, result in results.items():
+        if name in baselines and result["median"] > baselines[name]["median"] * (1 + tolerance):
+            regressions.append(name)
+    return regressions
+
+
+def format_results_table(results, baselines):
+    lines = [f"{'benchmark':<28} {'median ms':>10} {'min ms':>10} {'baseline ms':>12} {'change':>8}"]
+    for name, result in results.items():
+        line = f"{name:<28} {result['median'] * 1000:>10.2f} {result['min'] * 1000:>10.2f}"
+        if name in baselines:
+            change = result["median"] / baselines[name]["median"] - 1
+            line += f" {baselines[name]['median'] * 1000:>12.2f} {change:>+8.1%}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the converter on synthetic songs.")
+    parser.add_argument("benchmarks", nargs="*", help=f"benchmarks to run (default: all of {', '.join(BENCHMARKS)})")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=int, default=1, help="multiply fixture sizes by this much")
+    parser.add_argument("--baselines", default=BASELINE_FILENAME, help="JSON file of baseline timings")
+    parser.add_argument("--save-baselines", action="store_true", help="save these results as the new baselines")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE)
+    parser.add_argument("--skip-mixer-check", action="store_true",
+                        help="don't check that the numpy and torch mixing backends agree")
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name!r}")
+    setup_logging("error")
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines, "r", encoding="utf-8") as file:
+            baselines = json.load(file)
+    # baselines only hold for the fixture sizes they were measured at
+    baselines = {name: baseline for name, baseline in baselines.items() if baseline.get("scale", 1) == args.scale}
+
+    results = run_benchmarks(args.benchmarks, args.repeat, args.scale)
+    print(format_results_table(results, baselines))
+
+    if args.save_baselines:
+        with open(args.baselines, "w", encoding="utf-8") as file:
+            json.dump(baselines | {name: result | {"scale": args.scale} for name, result in results.items()},
+                      file, indent=1, sort_keys=True)
+        success(f"Baselines saved to {args.baselines}.")
+        return 0
+
+    failed_checks = []
+    if not args.skip_mixer_check:
+        mixer_error = compare_mixers()
+        if mixer_error is None:
+            info("torch isn't installed, skipping the mixing backend check.")
+        elif mixer_error > MIXER_TOLERANCE:
+            warning("The numpy and torch mixers differ by up to %.2e, over the tolerance of %.0e.", mixer_error,
+                    MIXER_TOLERANCE)
+            failed_checks.append("mixer check")
+        else:
+            info("The numpy and torch mixers agree within %.2e.", mixer_error)
+
+    regressions = find_regressions(results, baselines, args.tolerance)
+    if "import" in results and results["import"]["median"] > IMPORT_TIME_BUDGET:
+        warning("Importing the converter took %.3fs, over its budget of %.3fs.", results["import"]["median"], IMPORT_TIME_BUDGET)
+        regressions.append("import")
+    for name in regressions:
+        warning("%s regressed by more than %d%%.", name, args.tolerance * 100)
+    return 1 if regressions or failed_checks else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,96 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+from utils import *
+
+
+# Persistent, content-addressed cache of encoded samples. Entries are keyed by a hash of the raw sample bytes
+# plus the encode parameters, so identical keysounds in other containers, songs or game versions are only
+# encoded once. Entries are evicted least recently used first once the cache grows past max_size bytes.
+# The cache's size is kept as a running total, so it's only walked once to find it and again when it has to be
+# trimmed. Entries stored by other processes aren't counted until then.
+class EncodeCache:
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.size = None
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # payload is the raw sample (bytes-like) or the path of an extracted sample file
+    def key(self, payload, *encode_params):
+        sample_hash = hashlib.sha256()
+        if isinstance(payload, str):
+            with open(payload, "rb") as infile:
+                for chunk in iter(lambda: infile.read(1 << 20), b""):
+                    sample_hash.update(chunk)
+        else:
+            sample_hash.update(payload)
+        sample_hash.update(repr(encode_params).encode())
+        return sample_hash.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.ogg")
+
+    # on a hit, put the cached file at outfile and mark the entry as recently used
+    def fetch(self, key, outfile):
+        cached_file = self.path(key)
+        try:
+            os.utime(cached_file)
+        except FileNotFoundError:
+            return False
+        try:
+            link_or_copy(cached_file, outfile)
+        except FileNotFoundError:
+            # evicted by another worker in the meantime
+            return False
+        return True
+
+    def store(self, key, outfile):
+        cached_file = self.path(key)
+        os.makedirs(os.path.dirname(cached_file), exist_ok=True)
+        # copy under a temporary name first so concurrent readers never see a partial entry
+        (handle, temp_file) = tempfile.mkstemp(dir=os.path.dirname(cached_file), suffix=".tmp")
+        os.close(handle)
+        shutil.copyfile(outfile, temp_file)
+        stored_size = os.path.getsize(temp_file)
+        try:
+            stored_size -= os.path.getsize(cached_file)
+        except FileNotFoundError:
+            pass
+        os.replace(temp_file, cached_file)
+        with self.lock:
+            if self.size is not None:
+                self.size += stored_size
+
+    # (mtime, size, path) of every entry, also resetting the running size to their total
+    def _scan(self):
+        entries = []
+        for root, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if filename.endswith(".ogg"):
+                    stat = os.stat(os.path.join(root, filename))
+                    entries.append((stat.st_mtime, stat.st_size, os.path.join(root, filename)))
+        self.size = sum(size for _, size, _ in entries)
+        return entries
+
+    def evict(self):
+        with self.lock:
+            entries = self._scan() if self.size is None else None
+            if self.size <= self.max_size:
+                return
+            entries = sorted(entries if entries is not None else self._scan())
+            evicted = 0
+            for _, size, cached_file in entries:
+                if self.size <= self.max_size:
+                    break
+                try:
+                    os.remove(cached_file)
+                except FileNotFoundError:
+                    pass
+                self.size -= size
+                evicted += 1
+        info("Evicted %s least recently used sample(s) from the encode cache.", evicted)
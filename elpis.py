@@ -1,14 +1,23 @@
+import copy
+import functools
 import json
+import logging
 import os
 import re
-import shutil
 import struct
+import threading
+import time
 
-from audio import get_audio_samples_from_container, generate_bgm
+import numpy as np
+
+from audio import ContainerSession, convert_to_ogg_file
+from instrumentation import format_phase_table, get_child_cpu_seconds, get_peak_rss_kb, profile_call, reset_peak_rss, span
+from manifest import BuildManifest, get_inputs_fingerprint
+from scheduler import TaskGraph
 from utils import *
 from Misc_enums import *
 
-# initialize template bmson file
+# template bmson file, copied for every chart and never changed itself
 starter_bmson = {
     "version": "1.0.0",
     "info": {
@@ -36,11 +45,20 @@ starter_bmson = {
     "bga": {}
 }
 
-alt_containers = json.load(open('ALT_CONTAINER_FILE'))
+# alternate audio containers by song id and chart, loaded from ALT_CONTAINER_FILE the first time they're needed
+alt_containers = None
+alt_containers_lock = threading.Lock()
 
 EIGHT_ZERO_BYTES = b'\x00\x00\x00\x00\x00\x00\x00\x00'
 END_OF_CHART = b'\xFF\xFF\xFF\x7F\x00\x00\x00\x00'
 
+# bmson chart names by the difficulty letter of chart_names
+DIFFICULTY_NAMES = {"B": "BEGINNER", "N": "NORMAL", "H": "HYPER", "A": "ANOTHER", "L": "LEGGENDARIA"}
+
+# layout of a single 8-byte .1 chart event
+CHART_EVENT = np.dtype([("offset", "<i4"), ("type", "u1"), ("param", "u1"), ("value", "<u2")])
+KNOWN_EVENT_TYPES = [0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x08, 0x0C, 0x10]
+
 
 def cleanup_bmson(bmson):
     nonempty_sound_channels = []
@@ -51,141 +69,186 @@ def cleanup_bmson(bmson):
     return bmson
 
 
-def parse_chart(contents_dir, song_id, db_entry, chart_file, chart_offset, dir_index, container_path):
-    # handle audio container edge cases: check if the container directory exists instead of the container itself
-    if container_path == "":
-        container_dir = ""
-        if os.path.exists(os.path.join(contents_dir, "data", "sound", str(song_id))):
-            container_dir = os.path.join(
-                contents_dir, "data", "sound", str(song_id))
-        elif os.path.exists(os.path.join(contents_dir, "data", "sound", f"{song_id}_ifs", str(song_id))):
-            container_dir = os.path.join(
-                contents_dir, "data", "sound", f"{song_id}_ifs", str(song_id))
-        else:
-            error("Invalid container directory edge case, exiting...")
-
-        # Since there are multiple audio containers, import all of them
-        output_path = f"{os.path.join('.', 'out', str(song_id))}"
-        print("Looking for audio container files...")
-        for root, _, filenames in os.walk(container_dir):
-            for file in filenames:
-                (_, extension) = os.path.splitext(file)
-                if extension == ".2dx" or extension == ".s3p":
-                    shutil.copy(os.path.join(root, file), os.path.join(
-                        output_path, os.path.relpath(os.path.join(root, file), container_dir)))
-        
-    
+# Load a chart from the .1 file data as an array of events, stopping at the end-of-chart marker
+def decode_chart(chart_data, chart_offset):
+    event_count = (len(chart_data) - chart_offset) // CHART_EVENT.itemsize
+    events = np.frombuffer(chart_data, dtype=CHART_EVENT, count=event_count, offset=chart_offset)
+    end_of_chart = np.flatnonzero(events.view("<u8") == int.from_bytes(END_OF_CHART, "little"))
+    if len(end_of_chart) > 0:
+        events = events[:end_of_chart[0]]
+    return events
+
+
+# For every note event, find the sample most recently assigned to its player and column (0 if never changed)
+def current_samples_at(events, note_mask, sample_change_mask, note_columns):
+    columns = events["param"].astype(np.int64)
+    columns[note_mask] = note_columns
+    # notes and sample changes for P1 use even types (00/02), for P2 odd types (01/03)
+    keys = (events["type"].astype(np.int64) & 1) * 256 + columns
+
+    positions = np.flatnonzero(note_mask | sample_change_mask)
+    order = np.lexsort((positions, keys[positions]))
+    positions = positions[order]
+    position_keys = keys[positions]
+    is_change = sample_change_mask[positions]
+
+    # carry the latest sample change forward within each player/column group
+    group_starts = np.flatnonzero(np.r_[True, position_keys[1:] != position_keys[:-1]])
+    group_start = np.repeat(group_starts, np.diff(np.r_[group_starts, len(positions)]))
+    last_change = np.maximum.accumulate(np.where(is_change, np.arange(len(positions)), -1))
+    has_change = last_change >= group_start
+    samples = np.where(has_change, events["value"][positions[np.maximum(last_change, 0)]].astype(np.int64) - 1, 0)
+
+    # put the results back in chart order
+    note_samples = np.empty(len(events), dtype=np.int64)
+    note_samples[positions] = samples
+    return note_samples[note_mask]
+
+
+# Collect the indices of every sample a chart can play: sample changes (02/03), background samples (07),
+# plus sample 0, which every column starts out with
+def get_referenced_samples(chart_data, chart_offset):
+    events = decode_chart(chart_data, chart_offset)
+    event_types = events["type"]
+    sample_change_mask = ((event_types == 0x02) | (event_types == 0x03)) & (events["param"] != 8)
+    referenced_samples = events["value"][sample_change_mask | (event_types == 0x07)].astype(np.int64) - 1
+    return {0} | set(referenced_samples[referenced_samples >= 0].tolist())
+
+
+def get_alt_containers():
+    global alt_containers
+    with alt_containers_lock:
+        if alt_containers is None:
+            with open('ALT_CONTAINER_FILE', 'r', encoding="utf-8") as file:
+                alt_containers = json.load(file)
+    return alt_containers
+
+
+# Use the chart's alternate audio container (found in the song's sound directory) instead of the song's own,
+# if it has one
+def get_chart_container_path(song_id, dir_index, container_path, sound_path):
+    alt_containers = get_alt_containers()
     if song_id in alt_containers:
         if chart_names[str(dir_index)] in alt_containers[song_id]:
-            container_path = os.path.join(".", "out", song_id, alt_containers[song_id][chart_names[str(dir_index)]])
+            return os.path.join(sound_path, alt_containers[song_id][chart_names[str(dir_index)]])
     else:
-        print("No alternate containers found.")
+        info("No alternate containers found.")
+    return container_path
+
+
+# Per-song conversion state: where the song comes from and goes to, its container session, and the bmson
+# info shared by all of its charts. Source files are read in place from sound_path, never copied. Nothing
+# song-specific lives in module globals, so several songs can be converted at once in the same process.
+class SongContext:
+    def __init__(self, contents_dir, song_id, db_entry):
+        self.contents_dir = contents_dir
+        self.song_id = song_id
+        self.db_entry = db_entry
+        self.output_path = f"{os.path.join('.', 'out', str(song_id))}"
+        self.sound_path = None
+        self.session = None
+        self.summary = Summary(song_id=song_id)
+        # song-wide bmson fields, filled in as the song's assets are found
+        self.info = {}
+        self.bga = {}
+
+    def new_bmson(self):
+        bmson = copy.deepcopy(starter_bmson)
+        bmson["info"].update(copy.deepcopy(self.info))
+        bmson["bga"].update(copy.deepcopy(self.bga))
+        bmson["info"]["title"] = self.db_entry["title"]
+        bmson["info"]["artist"] = self.db_entry["artist"]
+        bmson["info"]["genre"] = self.db_entry["genre"]
+        return bmson
+
+    def warning(self, text, *args):
+        warning(text, *args, summary=self.summary)
+
+
+# Per-chart conversion state: the chart's place in the chart file, its container, and the bmson built from it
+class ChartContext:
+    def __init__(self, song, dir_index, chart_data, chart_offset, container_path):
+        self.song = song
+        self.dir_index = dir_index
+        self.chart_data = chart_data
+        self.chart_offset = chart_offset
+        self.container_path = container_path
+        self.bmson = song.new_bmson()
+        self.bgm_samples = []
+        self.bgm_channel = None
+        self.output_filename = os.path.join("out", str(song.song_id), f"{song.song_id}-{chart_names[str(dir_index)]}.bmson")
+
+
+# Parse a chart into its bmson. The background track's sound channel is left as a placeholder for render_chart_bgm
+# to fill in, so the chart can be parsed without waiting for its background track.
+def prepare_chart(chart):
+    with span(chart.song.summary, "chart parse"):
+        return build_chart_bmson(chart)
+
+
+def build_chart_bmson(chart):
+    (song_id, db_entry) = (chart.song.song_id, chart.song.db_entry)
+    (session, dir_index, container_path) = (chart.song.session, chart.dir_index, chart.container_path)
+    # songs without a container of their own (e.g. with several containers) only have alternate containers
+    container_path = get_chart_container_path(song_id, dir_index, container_path, chart.song.sound_path)
+    chart.container_path = container_path
 
     try:
-        audio_samples = get_audio_samples_from_container(song_id, container_path, db_entry["volume"] / 100)
+        # converting charts one after another, the first chart to use a container waits here for its samples to be
+        # encoded on the encode pool; on the task graph the container was planned up front and its encodes are
+        # separate tasks, so this only looks up the planned samples
+        with span(chart.song.summary, "encode wait"):
+            audio_samples = session.get_audio_samples(container_path, db_entry["volume"] / 100)
     except ValueError:
         error("ValueError: This song should use an alternate audio container, but isn't.")
 
-    bmson = starter_bmson
-    bmson["info"]["title"] = db_entry["title"]
-    bmson["info"]["artist"] = db_entry["artist"]
-    bmson["info"]["genre"] = db_entry["genre"]
+    bmson = chart.bmson
     bmson["info"]["mode_hint"] = "beat-7k" if dir_index < 6 else "beat-14k"
 
-    match dir_index:
-        case 0:
-            bmson["info"]["level"] = db_entry["SPH_level"]
-            bmson["info"]["chart_name"] = "HYPER"
-        case 1:
-            bmson["info"]["level"] = db_entry["SPN_level"]
-            bmson["info"]["chart_name"] = "NORMAL"
-        case 2:
-            bmson["info"]["level"] = db_entry["SPA_level"]
-            bmson["info"]["chart_name"] = "ANOTHER"
-        case 3:
-            bmson["info"]["level"] = db_entry["SPB_level"]
-            bmson["info"]["chart_name"] = "BEGINNER"
-        case 4:
-            bmson["info"]["level"] = db_entry["SPL_level"]
-            bmson["info"]["chart_name"] = "LEGGENDARIA"
-        case 6:
-            bmson["info"]["level"] = db_entry["DPH_level"]
-            bmson["info"]["chart_name"] = "HYPER"
-        case 7:
-            bmson["info"]["level"] = db_entry["DPN_level"]
-            bmson["info"]["chart_name"] = "NORMAL"
-        case 8:
-            bmson["info"]["level"] = db_entry["DPA_level"]
-            bmson["info"]["chart_name"] = "ANOTHER"
-        case 9:
-            bmson["info"]["level"] = db_entry["DPB_level"]
-            bmson["info"]["chart_name"] = "BEGINNER"
-        case 10:
-            bmson["info"]["level"] = db_entry["DPL_level"]
-            bmson["info"]["chart_name"] = "LEGGENDARIA"
-
-    bmson_output_filename = f"{song_id}-{chart_names[str(dir_index)]}.bmson"
+    bmson["info"]["level"] = db_entry[get_level_field(dir_index)]
+    bmson["info"]["chart_name"] = DIFFICULTY_NAMES[chart_names[str(dir_index)][-1]]
 
     # initialize sound_channels JSON object
     sound_channels = []
     for i in range(len(audio_samples)):
         sound_channels.append({"name": audio_samples[i], "notes": []})
 
-    current_samples = {
-        "P1": [0, 0, 0, 0, 0, 0, 0, 0],
-        "P2": [0, 0, 0, 0, 0, 0, 0, 0],
-    }
-
-    # initialize bpm and bpm intervals, and background audio samples and their respective offsets
-    bpm_intervals = []
-    chart_file.seek(chart_offset)
-    event = chart_file.read(8)
-    bgm_samples = []
-    bmson["bpm_events"] = []
-    bmson["lines"] = []
-    while event and END_OF_CHART not in event:
-        event_offset = (event[3] << 24) | (
-            event[2] << 16) | (event[1] << 8) | (event[0])
-        event_type = event[4]
-        event_param = event[5]
-        event_value = (event[7] << 8) | (event[6])
-
-        match event_type:
-            case 0x04:
-                # handle event type 04 (bpm change)
-                try:
-                    bpm = round(event_value / event_param)
-                except ZeroDivisionError:
-                    # prevent division by zero, thereby averting the implosion of the space-time continuum
-                    bpm = round(event_value)
-                bpm_intervals.append([event_offset, bpm])
-
-                if bmson["info"]["init_bpm"] == 0:
-                    bmson["info"]["init_bpm"] = bpm
-                    bmson["bpm_events"].append({
-                        "y": convert_to_pulses(event_offset, bpm_intervals, starter_bmson["info"]["resolution"]),
-                        "bpm": bpm
-                    })
-                    print(
-                        f"Event at {event_offset}ms: BPM initialized to {bpm}")
-                else:
-                    if bpm_intervals[-1] == event_offset:
-                        print(
-                            f"BPM change event already exists at {event_offset}ms, ignoring.")
-                    else:
-                        bmson["bpm_events"].append({
-                            "y": convert_to_pulses(event_offset, bpm_intervals, starter_bmson["info"]["resolution"]),
-                            "bpm": bpm
-                        })
-                        print(
-                            f"Event at {event_offset}ms: BPM change to {bpm}")
-            case 0x07:
-                # handle event type 07 (background sample)
-                print(
-                    f"Event at {event_offset}ms: Background sample {event_value - 1} (0-indexed)")
-                bgm_samples.append([event_offset, event_value - 1])
-
-        event = chart_file.read(8)
+    # decode the whole chart in one go, then pick out each kind of event with column masks
+    events = decode_chart(chart.chart_data, chart.chart_offset)
+    event_types = events["type"]
+    info("%s events decoded.", len(events))
+    chart.song.summary.add("events", len(events))
+    if logger.isEnabledFor(TRACE):
+        for offset, event_type, param, value in events.tolist():
+            trace("Event at %sms: type 0x%02X, param 0x%02X, value 0x%04X", offset, event_type, param, value)
+
+    unknown_event_mask = ~np.isin(event_types, KNOWN_EVENT_TYPES + list(unknown_events))
+    if unknown_event_mask.any():
+        unknown_event = events[unknown_event_mask][0]
+        error(
+            f"Unknown event at {unknown_event['offset']}ms, type {hex(unknown_event['type'])}, param {hex(unknown_event['param'])} and value {hex(unknown_event['value'])}.")
+
+    # handle event type 04 (bpm change)
+    bpm_changes = events[event_types == 0x04]
+    bpm_offsets = bpm_changes["offset"].astype(np.int64)
+    bpm_params = bpm_changes["param"].astype(np.float64)
+    bpm_values = bpm_changes["value"].astype(np.float64)
+    # prevent division by zero, thereby averting the implosion of the space-time continuum
+    bpms = np.round(np.where(bpm_params == 0, bpm_values, bpm_values / np.where(bpm_params == 0, 1, bpm_params)))
+    bpm_intervals = [[offset, bpm] for offset, bpm in zip(bpm_offsets.tolist(), bpms.astype(np.int64).tolist())]
+    if bmson["info"]["init_bpm"] == 0:
+        bmson["info"]["init_bpm"] = bpm_intervals[0][1]
+    info("%s BPM events found, initial BPM is %s.", len(bpm_intervals), bmson['info']['init_bpm'])
+
+    # build the tempo map once, then convert everything to pulses from it
+    with span(chart.song.summary, "pulse conversion"):
+        tempo_map = TempoMap(bpm_intervals, bmson["info"]["resolution"])
+        bmson["bpm_events"] = [{"y": y, "bpm": bpm} for y, bpm in zip(tempo_map.pulses_many(bpm_offsets).tolist(), bpms.astype(np.int64).tolist())]
+
+    # handle event type 07 (background sample)
+    background_samples = events[event_types == 0x07]
+    bgm_samples = [[offset, value - 1] for offset, value in zip(background_samples["offset"].tolist(), background_samples["value"].tolist())]
+    info("%s background samples found.", len(bgm_samples))
 
     # replace indices in bgm_samples with the actual files
     for i in range(len(bgm_samples)):
@@ -195,196 +258,310 @@ def parse_chart(contents_dir, song_id, db_entry, chart_file, chart_offset, dir_i
         except IndexError:
             error(f"IndexError: Sample index out of range for this container! This is probably the wrong container for the {chart_names[str(dir_index)]} chart.")
 
-    # generate bgm track for this specific chart
-    bgm_name = generate_bgm(bgm_samples, song_id, dir_index)
-
+    # the bgm track for this specific chart is generated later on
     note = {
         "x": 0,
         "y": 0,
         "l": 0,
         "c": False
     }
-    sound_channels.append({"name": bgm_name, "notes": [note]})
-    print("End of chart reached.")
+    chart.bgm_channel = {"name": "", "notes": [note]}
+    sound_channels.append(chart.bgm_channel)
 
     # ready to parse chart
-    chart_file.seek(chart_offset)
-    event = chart_file.read(8)
-    while event and END_OF_CHART not in event:
-        event_offset = (event[3] << 24) | (
-            event[2] << 16) | (event[1] << 8) | (event[0])
-        event_type = event[4]
-        event_param = event[5]
-        event_value = (event[7] << 8) | (event[6])
-
-        is_event_mss = event_param == 0x6B
-        match event_type:
-            case 0x00:
-                # handle event type 00 (visible note on playfield for P1)
-                if is_event_mss:
-                    # handle Multi-Spin Scratch
-                    event_param = 0x07
-                    print(
-                        f"Event at {event_offset}ms: Multi-Spin Scratch for P1,",
-                        f"hold for {event_value}ms")
-                else:
-                    print(
-                        f"Event at {event_offset}ms: Visible note for P1:",
-                        f"{columns_to_keys[event_param]}{', hold for ' + str(event_value) + 'ms' if event_value > 0 else ''}")
-                note = {
-                    "x": event_param + 1,
-                    "y": convert_to_pulses(event_offset, bpm_intervals, starter_bmson["info"]["resolution"]),
-                    "l": convert_to_pulses(event_value,  bpm_intervals, starter_bmson["info"]["resolution"]),
-                    "c": False
-                }
-                # give some space between MSS to prevent timing window overlap
-                if is_event_mss: 
-                    note["l"] -= 3
-                
-                if current_samples["P1"][event_param] <= len(sound_channels):
-                    sound_channels[current_samples["P1"][event_param]]["notes"].append(note)
-                else:
-                    error(f"IndexError: Audio container not found! This is the wrong container for the {chart_names[str(dir_index)]} chart.")
-            case 0x01:
-                # handle event type 01 (visible note on playfield for P2)
-                if is_event_mss:
-                    # handle Multi-Spin Scratch
-                    event_param = 0x07
-                    print(
-                        f"Event at {event_offset}ms: Multi-Spin Scratch for P2,",
-                        f"hold for {event_value}ms")
-                else:
-                    print(
-                        f"Event at {event_offset}ms: Visible note for P2:",
-                        f"{columns_to_keys[event_param]}{', hold for ' + str(event_value) + 'ms' if event_value > 0 else ''}")
-                note = {
-                    "x": event_param + 9,
-                    "y": convert_to_pulses(event_offset, bpm_intervals, starter_bmson["info"]["resolution"]),
-                    "l": convert_to_pulses(event_value,  bpm_intervals, starter_bmson["info"]["resolution"]),
-                    "c": False
-                }
-                # give some space between MSS to prevent timing window overlap
-                if is_event_mss:
-                    note["l"] -= 3
-                
-                if current_samples["P2"][event_param] <= len(sound_channels):
-                    sound_channels[current_samples["P2"][event_param]]["notes"].append(note)
-                else:
-                    error(f"IndexError: Audio container not found! This is the wrong container for the {chart_names[str(dir_index)]} chart.")
-            case 0x02:
-                # handle event type 02 (sample change for P1)
-                if event_param != 8:
-                    # malformed event, discovered in song id #01002
-                    print(
-                        f"Event at {event_offset}ms: Sample change for P1:",
-                        f"{columns_to_keys[event_param]} => sample {event_value - 1} (0-indexed)")
-                    current_samples["P1"][event_param] = event_value - 1
-                else:
-                    print(f"Event at {event_offset}ms: ILLEGAL SAMPLE CHANGE for P1: Key {event_param} does not exist!")
-            case 0x03:
-                # handle event type 03 (sample change for P2)
-                if event_param != 8:
-                    # malformed event, discovered in song id #01002
-                    print(
-                        f"Event at {event_offset}ms: Sample change for P2:",
-                        f"{columns_to_keys[event_param]} => sample {event_value - 1} (0-indexed)")
-                    current_samples["P2"][event_param] = event_value - 1
-                else:
-                    print(f"Event at {event_offset}ms: ILLEGAL SAMPLE CHANGE for P2: Key {event_param} does not exist!")
-            case 0x04:
-                # we already did this, so ignore
-                print(
-                    f"Event at {event_offset}ms: BPM change, ignoring.")
-            case 0x05:
-                # handle (or more specifically, don't handle) event type 05 (meter info)
-                print(
-                    f"Event at {event_offset}ms: Meter information, ignoring.")
-            case 0x06:
-                # handle event type 06 (end of song)
-                print(
-                    f"Event at {event_offset}ms: End of song, ignoring.")
-            case 0x07:
-                # we already did this, so ignore.
-                print(
-                    f"Event at {event_offset}ms: Background sample, ignoring.")
-            case 0x08:
-                # handle (or more specifically, don't handle) event type 08 (timing window info)
-                print(
-                    f"Event at {event_offset}ms: Timing window information, ignoring.")
-            case 0x0C:
-                # handle event type 0C (measure bar)
-                print(
-                    f"Event at {event_offset}ms: Measure bar for P{event_param + 1}")
-                bmson["lines"].append({"y": convert_to_pulses(
-                    event_offset, bpm_intervals, starter_bmson["info"]["resolution"])})
-            case 0x10:
-                # handle event type 10 (note count)
-                print(
-                    f"Event at {event_offset}ms: Note count for P{event_param + 1}: {event_value}")
-            case _:
-                # handle unknown event types
-                if event_type not in unknown_events:
-                    error(
-                        f"Unknown event at {event_offset}ms, type {hex(event_type)}, param {hex(event_param)} and value {hex(event_value)}.")
-
-        event = chart_file.read(8)
+    # handle event types 00/01 (visible notes for P1/P2) and 02/03 (sample changes for P1/P2)
+    note_mask = (event_types == 0x00) | (event_types == 0x01)
+    sample_change_mask = ((event_types == 0x02) | (event_types == 0x03)) & (events["param"] != 8)
+
+    # malformed event, discovered in song id #01002
+    for illegal_change in events[((event_types == 0x02) | (event_types == 0x03)) & (events["param"] == 8)]:
+        info("Event at %sms: ILLEGAL SAMPLE CHANGE for P%s: Key %s does not exist!", illegal_change['offset'], illegal_change['type'] - 1, illegal_change['param'])
+
+    notes = events[note_mask]
+    is_note_mss = notes["param"] == 0x6B
+    # handle Multi-Spin Scratch, which always lands on the scratch column
+    note_columns = np.where(is_note_mss, 0x07, notes["param"]).astype(np.int64)
+    note_samples = current_samples_at(events, note_mask, sample_change_mask, note_columns)
+
+    if (note_samples > len(sound_channels)).any():
+        error(f"IndexError: Audio container not found! This is the wrong container for the {chart_names[str(dir_index)]} chart.")
+
+    note_offsets = notes["offset"].astype(np.int64)
+    note_values = notes["value"].astype(np.int64)
+    note_xs = np.where(notes["type"] == 0x00, note_columns + 1, note_columns + 9)
+    with span(chart.song.summary, "pulse conversion"):
+        note_ys = tempo_map.pulses_many(note_offsets)
+        note_ls = tempo_map.lengths_many(note_offsets, note_values)
+    # give some space between MSS to prevent timing window overlap
+    note_ls = np.where(is_note_mss, note_ls - 3, note_ls)
+
+    for sample, x, y, l in zip(note_samples.tolist(), note_xs.tolist(), note_ys.tolist(), note_ls.tolist()):
+        sound_channels[sample]["notes"].append({"x": x, "y": y, "l": l, "c": False})
+    info("%s notes and %s sample changes parsed.", len(notes), np.count_nonzero(sample_change_mask))
+    chart.song.summary.add("notes", len(notes))
+
+    # handle event type 0C (measure bar)
+    measure_bars = events[event_types == 0x0C]
+    with span(chart.song.summary, "pulse conversion"):
+        bmson["lines"] = [{"y": y} for y in tempo_map.pulses_many(measure_bars["offset"]).tolist()]
 
     # Update video delay
     video_delay = db_entry["bga_delay"]
     if video_delay < 0:
         video_delay = 0
-    bmson["bga"]["bga_events"] = [{"id": 1, "y": convert_to_pulses(video_delay, bpm_intervals, starter_bmson["info"]["resolution"]) * 20}]
+    bmson["bga"]["bga_events"] = [{"id": 1, "y": tempo_map.pulses(video_delay) * 20}]
 
 
-    print("End of chart reached.")
+    info("End of chart reached.")
+    chart.song.summary.add("charts")
     bmson["sound_channels"] = sound_channels
-    bmson = cleanup_bmson(bmson)
-    bmson_output_filename = os.path.join(
-        "out", str(song_id), bmson_output_filename)
-    with open(bmson_output_filename, "w", encoding="utf-8") as file:
-        json.dump(bmson, file, ensure_ascii=False, sort_keys=True)
+    chart.bgm_samples = bgm_samples
+    return chart
+
+
+# generate the bgm track for a prepared chart (or reuse an identical one) and put it in its sound channel
+def render_chart_bgm(chart):
+    chart.bgm_channel["name"] = chart.song.session.get_bgm(chart.bgm_samples, chart.dir_index, chart.container_path)
+
+
+def write_chart(chart):
+    bmson = cleanup_bmson(chart.bmson)
+    with span(chart.song.summary, "json dump") as dump_span:
+        with open(chart.output_filename, "w", encoding="utf-8") as file:
+            json.dump(bmson, file, ensure_ascii=False, sort_keys=True)
+        dump_span.add_bytes(written=os.path.getsize(chart.output_filename))
+
+    success(f"{os.path.basename(chart.output_filename)} written.")
+
+
+def parse_chart(chart):
+    prepare_chart(chart)
+    render_chart_bgm(chart)
+    write_chart(chart)
+
+
+# write a chart's bmson, then let on_chart_written know the chart is done
+def write_and_record_chart(chart, on_chart_written):
+    write_chart(chart)
+    on_chart_written(chart.dir_index)
 
-    success(f"{os.path.basename(bmson_output_filename)} written.")
+
+# Convert a song's charts as a graph of tasks on a shared pool of task_workers threads:
+# sample encodes -> chart parse -> bgm render -> bmson write -> song finalize.
+# Container headers are parsed up front to plan the encodes, and task costs are estimated from
+# sample and chart sizes so the longest chains of work start first. Each chart's background track only
+# waits for the encodes of the samples it mixes, so it can be rendered while other samples are still encoding.
+def run_chart_tasks(song, chart_data, stale_charts, container_path, task_workers, on_chart_written, finalize_song):
+    (song_id, db_entry, session) = (song.song_id, song.db_entry, song.session)
+    # chart directory entries: offset and length of each chart
+    chart_directory = struct.unpack_from("<24I", chart_data)
+    volume_multiplier = db_entry["volume"] / 100
+    graph = TaskGraph()
+    planned_containers = {}
+    encode_tasks = {}
+    try:
+        for i in stale_charts:
+            chart_container_path = get_chart_container_path(song_id, i, container_path, song.sound_path)
+            if chart_container_path == "" or chart_container_path in planned_containers:
+                continue
+            (audio_container, sample_jobs) = session.plan_audio_samples(chart_container_path, volume_multiplier)
+            planned_containers[chart_container_path] = (audio_container, sample_jobs)
+            # encode tasks by sample file name without extension, e.g. "0003"
+            encode_tasks[chart_container_path] = {
+                os.path.splitext(os.path.basename(sample_file))[0]:
+                    graph.add(f"encode {os.path.basename(sample_file)}",
+                              functools.partial(convert_to_ogg_file, sample_file, song_id, volume_multiplier, payload,
+                                                session.encode_cache, song.summary),
+                              cost=payload.nbytes if payload is not None else os.path.getsize(sample_file))
+                for sample_file, payload in sample_jobs}
+
+        write_tasks = []
+        for i in stale_charts:
+            chart_container_path = get_chart_container_path(song_id, i, container_path, song.sound_path)
+            (chart_offset, chart_length) = chart_directory[i * 2:i * 2 + 2]
+            chart = ChartContext(song, i, chart_data, chart_offset, container_path)
+            parse_task = graph.add(f"parse {chart_names[str(i)]}", functools.partial(prepare_chart, chart),
+                                   cost=chart_length)
+
+            # mixing cost grows with the size of the samples being mixed
+            bgm_cost = chart_length
+            bgm_dependencies = [parse_task]
+            if chart_container_path in planned_containers:
+                container_samples = planned_containers[chart_container_path][0].samples
+                container_encode_tasks = encode_tasks[chart_container_path]
+                events = decode_chart(chart_data, chart_offset)
+                bgm_indices = (events["value"][events["type"] == 0x07].astype(np.int64) - 1).tolist()
+                for index in bgm_indices:
+                    if 0 <= index < len(container_samples):
+                        bgm_cost += container_samples[index].size
+                if all(0 <= index < len(container_samples) for index in bgm_indices):
+                    bgm_dependencies += [container_encode_tasks[f"{index:04d}"] for index in sorted(set(bgm_indices))
+                                         if f"{index:04d}" in container_encode_tasks]
+                else:
+                    # indices outside the container are either rejected or wrapped around by parsing, so any
+                    # sample could end up in the mix
+                    bgm_dependencies += list(container_encode_tasks.values())
+            bgm_task = graph.add(f"render {chart_names[str(i)]} bgm", functools.partial(render_chart_bgm, chart),
+                                 bgm_dependencies, bgm_cost)
+
+            write_tasks.append(graph.add(f"write {chart_names[str(i)]}",
+                                         functools.partial(write_and_record_chart, chart, on_chart_written),
+                                         [parse_task, bgm_task], chart_length // 8))
+
+        # every other task leads to finalize, and the graph never starts a task after a failure, so the manifest is
+        # only saved and the output directory only renamed once every encode and chart has been written
+        graph.add("finalize", finalize_song,
+                  write_tasks + [task for tasks in encode_tasks.values() for task in tasks.values()])
+        failed_tasks = graph.run(task_workers)
+    finally:
+        # payloads of encodes that never ran have to be released before their container can be closed
+        for audio_container, sample_jobs in planned_containers.values():
+            for _, payload in sample_jobs:
+                if payload is not None:
+                    payload.release()
+            audio_container.close()
+
+    if session.encode_cache is not None:
+        session.encode_cache.evict()
+    for task in failed_tasks:
+        song.warning("Task '%s' failed: %s", task.name, task.error)
+    if failed_tasks:
+        if isinstance(failed_tasks[0].error, ConversionError):
+            raise failed_tasks[0].error
+        error(f"{len(failed_tasks)} task(s) failed while converting song #{song_id}, exiting...")
+
+
+# Directory indices of the charts a song has according to its db entry (charts with a level of 0 don't exist)
+def get_charts_to_parse(song_id, db_entry):
+    charts_to_parse = []
+    for i in range(12):
+        if str(i) in chart_names and db_entry[get_level_field(i)] != 0:
+            # work around song-specific bug for SP-N and DP-N charts
+            if song_id == '30100' and i in [1, 7]:
+                continue
+            charts_to_parse.append(i)
+    return charts_to_parse
+
+
+# Output folder name for a finished song: its output path with the ASCII title appended
+def get_safe_folder_name(output_path, db_entry):
+    # append ASCII title to folder
+    safe_folder_name = output_path + " - " + db_entry["title_ascii"]
+    # replace reserved characters with underscore
+    reserved_chars = r'[<>:"\\|?*]'
+    safe_folder_name = re.sub(reserved_chars, '_', safe_folder_name)
+    # remove trailing dots and spaces
+    return "." + safe_folder_name.rstrip('. ').lstrip('. ')
 
 
-def parse_all_charts_and_audio(contents_dir, song_id, db_entry):
+# Link an external asset into the output directory (copying it only when it can't be linked), unless it's
+# unchanged since the last run. Linked assets share their data with the game files, so they take no extra space.
+def import_asset(source_path, output_path, manifest, summary=None):
+    stage = f"asset:{os.path.basename(source_path)}"
+    fingerprint = get_inputs_fingerprint([source_path])
+    destination = os.path.join(output_path, os.path.basename(source_path))
+    if manifest.is_fresh(stage, fingerprint) and os.path.exists(destination):
+        info("%s is unchanged, skipping.", os.path.basename(source_path))
+    else:
+        with span(summary, "asset import") as import_span:
+            if os.path.lexists(destination):
+                os.remove(destination)
+            method = link_or_copy(source_path, destination)
+            if method == "copy":
+                import_span.add_bytes(read=os.path.getsize(source_path), written=os.path.getsize(source_path))
+        trace("%s imported (%s).", os.path.basename(source_path), method)
+        manifest.record(stage, fingerprint)
+
+
+# Convert a song, returning its summary, including the time and I/O spent in each phase. If summary_log is given,
+# the summary is also appended to it as a JSON line, whether the conversion succeeded or not. If profile_path is
+# given, the conversion runs under cProfile and the stats are saved there.
+def parse_all_charts_and_audio(contents_dir, song_id, db_entry, encode_workers=None, encode_cache=None, task_workers=None,
+                               summary_log=None, profile_path=None):
+    song = SongContext(contents_dir, song_id, db_entry)
+    start_time = time.time()
+    start_child_cpu = get_child_cpu_seconds()
+    start_peak_rss = get_peak_rss_kb()
+    peak_rss_was_reset = reset_peak_rss()
+    try:
+        if profile_path is not None:
+            profile_call(profile_path, convert_song, song, encode_workers, encode_cache, task_workers)
+        else:
+            convert_song(song, encode_workers, encode_cache, task_workers)
+        song.summary.set("status", "ok")
+    except ConversionError as e:
+        song.summary.set("status", "failed")
+        song.summary.set("reason", str(e))
+        raise
+    except Exception as e:
+        song.summary.set("status", "failed")
+        song.summary.set("reason", f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        song.summary.set("seconds", round(time.time() - start_time, 3))
+        if start_child_cpu is not None:
+            # ffmpeg's CPU time, only exact when no other song is being converted in this process
+            song.summary.set("child_cpu", round(get_child_cpu_seconds() - start_child_cpu, 3))
+        # the song's own peak, only exact when no other song is being converted in this process. Where the peak
+        # can't be reset, it's the worker's peak so far, which is only the song's if the song raised it
+        peak_rss = get_peak_rss_kb()
+        if peak_rss_was_reset or (peak_rss is not None and start_peak_rss is not None and peak_rss > start_peak_rss):
+            song.summary.set("peak_rss_kb", peak_rss)
+        if logger.isEnabledFor(logging.DEBUG):
+            debug("Phases of song #%s:\n%s", song_id, format_phase_table(song.summary.to_dict().get("phases", {})))
+        if summary_log is not None:
+            append_json_line(summary_log, song.summary.to_dict())
+    return song.summary.to_dict()
+
+
+def convert_song(song, encode_workers=None, encode_cache=None, task_workers=None):
+    (contents_dir, song_id, db_entry) = (song.contents_dir, song.song_id, song.db_entry)
+    output_path = song.output_path
+    safe_folder_name = get_safe_folder_name(output_path, db_entry)
+
+    # pick up the output of a previous run, so unchanged stages don't have to be redone
+    if not os.path.exists(output_path) and os.path.exists(safe_folder_name):
+        os.rename(safe_folder_name, output_path)
+        info("Found previous output directory %s, updating it.", os.path.basename(safe_folder_name))
+
     # create output directory if it doesn't exist yet
-    output_path = f"{os.path.join('.', 'out', str(song_id))}"
     if os.path.exists(output_path):
-        print(f"Output path {output_path} already exists, using it.")
+        info("Output path %s already exists, using it.", output_path)
     else:
         os.makedirs(output_path)
-        print(f"Output path {output_path} created.")
+        info("Output path %s created.", output_path)
+    manifest = BuildManifest(output_path, song.summary)
 
     # External files
+    imported_assets = []
 
     # check if title image path exists, and if so import it (optional)
     title_image_path = os.path.join(
         contents_dir, "data", "graphic", f"i_{song_id}_ifs", f"i_{song_id}.png")
     if os.path.exists(title_image_path):
-        print(
-            f"Found title image file {os.path.basename(title_image_path)}, importing it...")
-        shutil.copy(title_image_path, output_path)
+        info("Found title image file %s, importing it...", os.path.basename(title_image_path))
+        import_asset(title_image_path, output_path, manifest, song.summary)
+        imported_assets.append(os.path.basename(title_image_path))
         title_image_path = os.path.join("out", str(
             song_id), os.path.basename(title_image_path))
-        starter_bmson["info"]["title_image"] = os.path.basename(
+        song.info["title_image"] = os.path.basename(
             title_image_path)
     else:
-        print("No title image found, this is probably intentional.")
+        info("No title image found, this is probably intentional.")
 
     # check if eyecatch image path exists, and if so import it (optional)
     eyecatch_image_path = os.path.join(
         "custom", "eyecatches", f"{song_id}.jpg")
     if os.path.exists(eyecatch_image_path):
-        print(
-            f"Found eyecatch image file {os.path.basename(eyecatch_image_path)}, importing it...")
-        shutil.copy(eyecatch_image_path, output_path)
+        info("Found eyecatch image file %s, importing it...", os.path.basename(eyecatch_image_path))
+        import_asset(eyecatch_image_path, output_path, manifest, song.summary)
+        imported_assets.append(os.path.basename(eyecatch_image_path))
         eyecatch_image_path = os.path.join("out", str(
             song_id), os.path.basename(eyecatch_image_path))
-        starter_bmson["info"]["eyecatch_image"] = os.path.basename(
+        song.info["eyecatch_image"] = os.path.basename(
             eyecatch_image_path)
     else:
-        warning("No eyecatch image found, I hope you know what you're doing!")
+        song.warning("No eyecatch image found, I hope you know what you're doing!")
 
     # check if video path exists, and if so import it (optional)
     video_path = ""
@@ -394,21 +571,21 @@ def parse_all_charts_and_audio(contents_dir, song_id, db_entry):
         video_path = os.path.join(
             contents_dir, "data", "movie", f"{song_id}.mp4")
     else:
-        warning("No video found, I hope you know what you're doing!")
+        song.warning("No video found, I hope you know what you're doing!")
 
     if video_path != "":
-        print(
-            f"Found video file {os.path.basename(video_path)}, importing it...")
-        shutil.copy(video_path, output_path)
+        info("Found video file %s, importing it...", os.path.basename(video_path))
+        import_asset(video_path, output_path, manifest, song.summary)
+        imported_assets.append(os.path.basename(video_path))
         video_path = os.path.join(str(
             song_id), os.path.basename(video_path))
-        starter_bmson["bga"]["bga_events"] = [{"id": 1, "y": 0}]
-        starter_bmson["bga"]["bga_header"] = [
+        song.bga["bga_events"] = [{"id": 1, "y": 0}]
+        song.bga["bga_header"] = [
             {"id": 1, "name": os.path.basename(video_path)}]
 
     # Internal files
 
-    # import all relevant files
+    # find all relevant files
     sound_path = ""
     if os.path.exists(os.path.join(contents_dir, "data", "sound", song_id)):
         sound_path = os.path.join(contents_dir, "data", "sound", song_id)
@@ -416,106 +593,109 @@ def parse_all_charts_and_audio(contents_dir, song_id, db_entry):
         sound_path = os.path.join(contents_dir, "data", "sound", f"{song_id}_ifs", song_id)
     else:
         error("Invalid sound path, exiting...")
+    song.sound_path = sound_path
 
-    for _, _, filenames in os.walk(os.path.join(".", sound_path)):
-        for file in filenames:
-            shutil.copy(os.path.join(".", sound_path, file), output_path)
-            print(f"{os.path.basename(file)} imported.")
+    charts_to_parse = get_charts_to_parse(song_id, db_entry)
 
+    # the chart file, containers and preview are all read straight from the sound directory
     # check if chart file path exists (REQUIRED)
-    chart_path = ""
-    if os.path.exists(os.path.join(".", "out", song_id, f"{song_id}.1")):
-        chart_path = os.path.join(".", "out", song_id, f"{song_id}.1")
-        print(f"Found chart file {os.path.basename(chart_path)}.")
+    chart_path = os.path.join(sound_path, f"{song_id}.1")
+    if os.path.exists(chart_path):
+        info("Found chart file %s.", os.path.basename(chart_path))
     else:
         error("Invalid chart path, exiting...")
 
     # check if song container path exists
     container_path = ""
-    if os.path.exists(os.path.join(".", "out", song_id, f"{song_id}.2dx")):
-        container_path = os.path.join(".", "out", song_id, f"{song_id}.2dx")
-        print(f"Found container file {os.path.basename(container_path)}.")
-    elif os.path.exists(os.path.join(".", "out", song_id, f"{song_id}.s3p")):
-        container_path = os.path.join(".", "out", song_id, f"{song_id}.s3p")
-        print(f"Found container file {os.path.basename(container_path)}.")
+    if os.path.exists(os.path.join(sound_path, f"{song_id}.2dx")):
+        container_path = os.path.join(sound_path, f"{song_id}.2dx")
+        info("Found container file %s.", os.path.basename(container_path))
+    elif os.path.exists(os.path.join(sound_path, f"{song_id}.s3p")):
+        container_path = os.path.join(sound_path, f"{song_id}.s3p")
+        info("Found container file %s.", os.path.basename(container_path))
     else:
-        print("Container file not yet found, circling back later.")
+        info("No container file found, charts will use their alternate containers.")
 
-    # check if song preview path exists, and if so import it (REQUIRED)
-    if os.path.exists(os.path.join(".", "out", song_id, f"{song_id}_pre.2dx")):
-        preview_path = os.path.join(".", "out", song_id, f"{song_id}_pre.2dx")
-        print(f"Found preview file {os.path.basename(preview_path)}.")
+    # check if song preview path exists (REQUIRED)
+    preview_path = os.path.join(sound_path, f"{song_id}_pre.2dx")
+    if os.path.exists(preview_path):
+        info("Found preview file %s.", os.path.basename(preview_path))
     else:
         error("Invalid preview path, exiting...")
 
-    # extract audio preview
-    extracted_preview_path = \
-        get_audio_samples_from_container(song_id,
-                                         os.path.join(".", "out", str(song_id), os.path.basename(preview_path)))[0]
-    starter_bmson["info"]["preview_music"] = os.path.join(
-        song_id, os.path.basename(extracted_preview_path))
-
-    # parse chart directory entries
-    with open(chart_path, 'rb') as chart_file:
-        chart_directory = []
-        file_offset = 0
-        for i in range(12):
-            chart_file.seek(file_offset)
-            chart_directory.append(struct.unpack("<I", chart_file.read(4))[0])
-            file_offset += 8
-
-        # iterate over all (existing) charts found inside chart file
-        # but for now, we start with the SP-HYPER chart
-        for i in range(len(chart_directory)):
-            # Find out if a chart is not supposed to exist in the db
-            chart_level_is_zero = False
-
-            if str(i) in chart_names:
-                match (chart_names[str(i)]):
-                    case "SP-H": 
-                        if db_entry["SPH_level"] == 0: chart_level_is_zero = True
-                    case "SP-N": 
-                        if db_entry["SPN_level"] == 0: chart_level_is_zero = True
-                    case "SP-A": 
-                        if db_entry["SPA_level"] == 0: chart_level_is_zero = True
-                    case "SP-B": 
-                        if db_entry["SPB_level"] == 0: chart_level_is_zero = True
-                    case "SP-L": 
-                        if db_entry["SPL_level"] == 0: chart_level_is_zero = True
-                    case "DP-H": 
-                        if db_entry["DPH_level"] == 0: chart_level_is_zero = True
-                    case "DP-N": 
-                        if db_entry["DPN_level"] == 0: chart_level_is_zero = True
-                    case "DP-A": 
-                        if db_entry["DPA_level"] == 0: chart_level_is_zero = True
-                    case "DP-B": 
-                        if db_entry["DPB_level"] == 0: chart_level_is_zero = True
-                    case "DP-L": 
-                        if db_entry["DPL_level"] == 0: chart_level_is_zero = True
-                    case _:
-                        continue
-
-                if not chart_level_is_zero:
-                    # work around song-specific bug for SP-N and DP-N charts
-                    if song_id == '30100' and i in [1, 7]:
-                        continue
-                    parse_chart(contents_dir, song_id, db_entry, chart_file,
-                                chart_directory[i], i, container_path)
-
-    # we're done with source files, remove them from output directory
-    for _, _, filenames in os.walk(output_path):
-        for file in filenames:
-            (_, extension) = os.path.splitext(file)
-            if extension == ".1" or extension == ".2dx" or extension == ".s3p":
-                os.remove(os.path.join(output_path, file))
-                print(f"{file} deleted.")
+    # work out which stages are out of date: the preview, each container, and each chart
+    song.info["preview_music"] = os.path.join(song_id, "preview.ogg")
+    preview_fingerprint = get_inputs_fingerprint([preview_path])
+    preview_is_fresh = manifest.is_fresh("preview", preview_fingerprint) and \
+        os.path.exists(os.path.join(output_path, song_id, "preview.ogg"))
+
+    container_fingerprints = {}
+    chart_fingerprints = {}
+    stale_charts = []
+    for i in charts_to_parse:
+        chart_container_path = get_chart_container_path(song_id, i, container_path, sound_path)
+        # without a container of its own, the chart's inputs are whatever is in the sound directory
+        container_fingerprints[chart_container_path] = get_inputs_fingerprint(
+            [chart_container_path or sound_path], db_entry["volume"])
+        chart_fields = {field: db_entry[field] for field in ["title", "artist", "genre", "bga_delay", "volume", get_level_field(i)]}
+        chart_fields["assets"] = imported_assets
+        chart_fingerprints[i] = get_inputs_fingerprint(
+            [chart_path, preview_path, chart_container_path or sound_path], chart_fields)
+
+        bmson_output_filename = os.path.join(output_path, f"{song_id}-{chart_names[str(i)]}.bmson")
+        if manifest.is_fresh(f"chart:{chart_names[str(i)]}", chart_fingerprints[i]) and os.path.exists(bmson_output_filename):
+            info("%s is up to date, skipping.", os.path.basename(bmson_output_filename))
+        else:
+            stale_charts.append(i)
 
-    # append ASCII title to folder
-    safe_folder_name = output_path + " - " + db_entry["title_ascii"]
-    # replace reserved characters with underscore
-    reserved_chars = r'[<>:"\\|?*]'
-    safe_folder_name = re.sub(reserved_chars, '_', safe_folder_name)
-    # remove trailing dots and spaces
-    safe_folder_name = "." + safe_folder_name.rstrip('. ').lstrip('. ')
-    os.rename(output_path, safe_folder_name)
-    success(f"Renamed output directory to {os.path.basename(safe_folder_name)}.")
+    def finalize_song():
+        manifest.save()
+
+        os.rename(output_path, safe_folder_name)
+        success(f"Renamed output directory to {os.path.basename(safe_folder_name)}.")
+
+    if preview_is_fresh and stale_charts == []:
+        success("Everything is up to date, nothing to convert.")
+    else:
+        # samples encoded from an older version of a container must be encoded again
+        for chart_container_path, fingerprint in container_fingerprints.items():
+            stage = f"container:{os.path.basename(chart_container_path)}"
+            container_output_path = os.path.join(output_path, os.path.splitext(os.path.basename(chart_container_path))[0])
+            if chart_container_path != "" and not manifest.is_fresh(stage, fingerprint) and os.path.exists(container_output_path):
+                info("%s has changed, removing its old samples.", os.path.basename(chart_container_path))
+                for filename in os.listdir(container_output_path):
+                    if filename != "preview.ogg":
+                        os.remove(os.path.join(container_output_path, filename))
+        if not preview_is_fresh and os.path.exists(os.path.join(output_path, song_id, "preview.ogg")):
+            os.remove(os.path.join(output_path, song_id, "preview.ogg"))
+
+        # extract audio preview
+        session = ContainerSession(song_id, encode_workers, encode_cache, manifest, song.summary)
+        song.session = session
+        session.get_audio_samples(preview_path)
+        manifest.record("preview", preview_fingerprint)
+
+        # load the whole chart file once and parse chart directory entries (12 entries of offset + length)
+        with open(chart_path, 'rb') as chart_file:
+            chart_data = chart_file.read()
+        chart_directory = list(struct.unpack_from("<24I", chart_data)[::2])
+
+        # only encode the samples that some chart actually references
+        for i in stale_charts:
+            session.add_wanted_samples(get_chart_container_path(song_id, i, container_path, song.sound_path),
+                                       get_referenced_samples(chart_data, chart_directory[i]))
+
+        def record_chart(i):
+            manifest.record(f"chart:{chart_names[str(i)]}", chart_fingerprints[i])
+            chart_container_path = get_chart_container_path(song_id, i, container_path, sound_path)
+            manifest.record(f"container:{os.path.basename(chart_container_path)}", container_fingerprints[chart_container_path])
+
+        if task_workers:
+            run_chart_tasks(song, chart_data, stale_charts, container_path, task_workers, record_chart, finalize_song)
+            return
+
+        for i in stale_charts:
+            parse_chart(ChartContext(song, i, chart_data, chart_directory[i], container_path))
+            record_chart(i)
+
+    finalize_song()
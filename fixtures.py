@@ -0,0 +1,188 @@
+import argparse
+import io
+import json
+import math
+import os
+import random
+import struct
+import wave
+
+from Misc_enums import *
+
+END_OF_CHART = b'\xFF\xFF\xFF\x7F\x00\x00\x00\x00'
+CHART_DIRECTORY_ENTRIES = 12
+
+
+# Synthetic game files for benchmarking and testing without real game data: .1 charts, .2dx/.s3p containers
+# filled with generated PCM, and whole songs laid out like the game's contents directory.
+# Only needs the standard library, so fixtures can be generated without the converter's dependencies.
+
+
+# A short tone as 16-bit PCM .wav data
+def generate_pcm(duration_ms=250, sample_rate=44100, channels=2, frequency=440.0, seed=0):
+    rng = random.Random(seed)
+    frame_count = sample_rate * duration_ms // 1000
+    frames = bytearray()
+    for i in range(frame_count):
+        # fade out so samples don't click when mixed
+        amplitude = 0.3 * (1 - i / frame_count)
+        value = int(32767 * (amplitude * math.sin(2 * math.pi * frequency * i / sample_rate) + 0.01 * rng.uniform(-1, 1)))
+        frames += struct.pack("<h", value) * channels
+
+    wav_data = io.BytesIO()
+    with wave.open(wav_data, "wb") as wav_file:
+        wav_file.setnchannels(channels)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(bytes(frames))
+    return wav_data.getvalue()
+
+
+def generate_payloads(sample_count, duration_ms=250, seed=0):
+    return [generate_pcm(duration_ms, frequency=220.0 * 2 ** (i % 24 / 12), seed=seed + i) for i in range(sample_count)]
+
+
+# .2dx: file count at 0x14 and sample offsets from 0x48, each sample a 2DX9 header followed by its payload
+def write_2dx(path, payloads):
+    header = bytearray(0x48 + 4 * len(payloads))
+    name = os.path.basename(path).encode()[:16]
+    header[:len(name)] = name
+    struct.pack_into("<II", header, 0x10, len(header), len(payloads))
+
+    body = bytearray()
+    for i, payload in enumerate(payloads):
+        struct.pack_into("<I", header, 0x48 + 4 * i, len(header) + len(body))
+        # magic, header size, payload size, then unknown fields (0x3231, track id, attenuation, loop point)
+        body += b'2DX9' + struct.pack("<IIHhHHi", 24, len(payload), 0x3231, -1, 64, 1, 0) + payload
+
+    with open(path, "wb") as file:
+        file.write(header + body)
+
+
+# .s3p: S3P0, file count, then (offset, length) pairs, each sample an S3V0 header followed by its payload.
+# The game's samples are WMA; generated ones are WAV, which ffmpeg and torchaudio read just the same.
+def write_s3p(path, payloads):
+    header = bytearray(8 + 8 * len(payloads))
+    header[:4] = b'S3P0'
+    struct.pack_into("<I", header, 0x04, len(payloads))
+
+    body = bytearray()
+    for i, payload in enumerate(payloads):
+        entry = b'S3V0' + struct.pack("<II", 32, len(payload)) + bytes(20) + payload
+        struct.pack_into("<II", header, 8 + 8 * i, len(header) + len(body), len(entry))
+        body += entry
+
+    with open(path, "wb") as file:
+        file.write(header + body)
+
+
+def write_container(path, payloads):
+    if path.endswith(".2dx"):
+        write_2dx(path, payloads)
+    elif path.endswith(".s3p"):
+        write_s3p(path, payloads)
+    else:
+        raise ValueError(f"Unknown container type for {path}")
+
+
+# Events of a playable chart: notes and sample changes for P1 (and P2 for DP charts), background samples,
+# measure bars, and BPM changes. bpm_change_density is the chance of a BPM change at each measure.
+def generate_chart(event_count=2000, bpm_change_density=0.05, sample_count=64, double_play=False, seed=0):
+    rng = random.Random(seed)
+    bpm = rng.randint(120, 200)
+    events = [struct.pack("<iBBH", 0, 0x04, 1, bpm)]
+    time = 0
+    next_measure = 0
+    players = [0, 1] if double_play else [0]
+    while len(events) < event_count:
+        if time >= next_measure:
+            events.append(struct.pack("<iBBH", next_measure, 0x0C, 0, 0))
+            if rng.random() < bpm_change_density:
+                bpm = max(60, min(400, bpm + rng.randint(-40, 40)))
+                events.append(struct.pack("<iBBH", next_measure, 0x04, 1, bpm))
+            next_measure += 4 * 60000 // bpm
+            continue
+
+        player = rng.choice(players)
+        column = rng.randint(0, 7)
+        kind = rng.random()
+        if kind < 0.55:
+            # mostly taps, sometimes a hold
+            length = rng.choice([0] * 9 + [rng.randint(100, 1000)])
+            events.append(struct.pack("<iBBH", time, 0x00 + player, column, length))
+        elif kind < 0.85:
+            events.append(struct.pack("<iBBH", time, 0x02 + player, column, rng.randint(1, sample_count)))
+        else:
+            events.append(struct.pack("<iBBH", time, 0x07, 0, rng.randint(1, sample_count)))
+        time += rng.randint(0, 120)
+
+    return b''.join(events) + END_OF_CHART
+
+
+# A .1 file: a directory of (offset, length) for each of the 12 chart slots, followed by the charts
+def write_chart_file(path, charts):
+    directory = bytearray(8 * CHART_DIRECTORY_ENTRIES)
+    data = bytearray()
+    for dir_index, chart_data in sorted(charts.items()):
+        struct.pack_into("<II", directory, 8 * dir_index, len(directory) + len(data), len(chart_data))
+        data += chart_data
+
+    with open(path, "wb") as file:
+        file.write(directory + data)
+
+
+def generate_db_entry(song_id, dir_indices, volume=100):
+    db_entry = {
+        "title": f"Synthetic {song_id}",
+        "title_ascii": f"Synthetic {song_id}",
+        "artist": "elpis",
+        "genre": "BENCHMARK",
+        "bga_delay": 0,
+        "volume": volume
+    }
+    for dir_index, chart_name in chart_names.items():
+        db_entry[chart_name.replace("-", "") + "_level"] = 0
+    for dir_index in dir_indices:
+        db_entry[chart_names[str(dir_index)].replace("-", "") + "_level"] = 1 + dir_index % 12
+    return db_entry
+
+
+# Write a whole song (chart file, sample container and preview) into contents_dir/data/sound/<song id>,
+# returning its db entry
+def generate_song(contents_dir, song_id, dir_indices=(0, 2, 6), event_count=2000, bpm_change_density=0.05,
+                  sample_count=64, sample_duration_ms=250, container_format="2dx", seed=0):
+    sound_path = os.path.join(contents_dir, "data", "sound", song_id)
+    os.makedirs(sound_path, exist_ok=True)
+
+    charts = {dir_index: generate_chart(event_count, bpm_change_density, sample_count, dir_index >= 6, seed + dir_index)
+              for dir_index in dir_indices}
+    write_chart_file(os.path.join(sound_path, f"{song_id}.1"), charts)
+    write_container(os.path.join(sound_path, f"{song_id}.{container_format}"),
+                    generate_payloads(sample_count, sample_duration_ms, seed))
+    write_2dx(os.path.join(sound_path, f"{song_id}_pre.2dx"), generate_payloads(1, 2000, seed))
+    return generate_db_entry(song_id, dir_indices)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic song for testing and benchmarking.")
+    parser.add_argument("contents_dir", help="contents directory to write data/sound/<song id> into")
+    parser.add_argument("song_id")
+    parser.add_argument("--charts", default="0,2,6", help="comma-separated chart directory indices")
+    parser.add_argument("--events", type=int, default=2000, help="events per chart")
+    parser.add_argument("--bpm-changes", type=float, default=0.05, help="chance of a BPM change per measure")
+    parser.add_argument("--samples", type=int, default=64, help="samples in the container")
+    parser.add_argument("--format", choices=["2dx", "s3p"], default="2dx")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--db-entry", default=None, help="also write the song's db entry to this JSON file")
+    args = parser.parse_args()
+
+    song_id = args.song_id.zfill(5)
+    db_entry = generate_song(args.contents_dir, song_id, [int(i) for i in args.charts.split(",")], args.events,
+                             args.bpm_changes, args.samples, container_format=args.format, seed=args.seed)
+    if args.db_entry is not None:
+        with open(args.db_entry, "w", encoding="utf-8") as file:
+            json.dump({song_id: db_entry}, file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from manifest import CONVERTER_VERSION
+from utils import *
+from Misc_enums import *
+
+INDEX_FILENAME = "elpis-index.sqlite"
+# bump this whenever the schema changes, older indexes are then rebuilt from scratch
+INDEX_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE songs (
+    song_id TEXT PRIMARY KEY,
+    title TEXT,
+    title_ascii TEXT,
+    artist TEXT,
+    genre TEXT,
+    db_entry TEXT NOT NULL,
+    sound_path TEXT,
+    inputs_fingerprint TEXT,
+    converted_fingerprint TEXT
+);
+CREATE TABLE charts (
+    song_id TEXT NOT NULL,
+    dir_index INTEGER NOT NULL,
+    chart_name TEXT NOT NULL,
+    level INTEGER NOT NULL,
+    PRIMARY KEY (song_id, dir_index)
+);
+CREATE INDEX charts_by_name ON charts (chart_name, level);
+CREATE TABLE alt_containers (
+    song_id TEXT NOT NULL,
+    chart_name TEXT NOT NULL,
+    container TEXT NOT NULL,
+    PRIMARY KEY (song_id, chart_name)
+);
+CREATE TABLE files (
+    song_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER
+);
+CREATE INDEX files_by_song ON files (song_id, kind);
+"""
+
+
+# Directory listing as {name: DirEntry}, empty if the directory doesn't exist
+def scan_directory(path):
+    try:
+        with os.scandir(path) as entries:
+            return {entry.name: entry for entry in entries}
+    except (FileNotFoundError, NotADirectoryError):
+        return {}
+
+
+def get_file_row(song_id, kind, entry):
+    stat = entry.stat()
+    return (song_id, kind, entry.path, stat.st_size, stat.st_mtime_ns)
+
+
+# Source files of every song, found with one listing per directory instead of probing each song's possible paths.
+# Returns each song's sound directory and (song id, kind, path, size, mtime) rows of the files a conversion reads.
+def scan_song_files(contents_dir, song_ids):
+    sound_dir = os.path.join(contents_dir, "data", "sound")
+    sound_entries = scan_directory(sound_dir)
+    movie_entries = scan_directory(os.path.join(contents_dir, "data", "movie"))
+    graphic_entries = scan_directory(os.path.join(contents_dir, "data", "graphic"))
+    custom_video_entries = scan_directory(os.path.join("custom", "videos"))
+    eyecatch_entries = scan_directory(os.path.join("custom", "eyecatches"))
+
+    sound_paths = {}
+    file_rows = []
+    for song_id in song_ids:
+        # same lookup order as the converter: data/sound/<id>, then data/sound/<id>_ifs/<id>
+        if song_id in sound_entries and sound_entries[song_id].is_dir():
+            sound_paths[song_id] = sound_entries[song_id].path
+        elif f"{song_id}_ifs" in sound_entries and os.path.isdir(os.path.join(sound_entries[f"{song_id}_ifs"].path, song_id)):
+            sound_paths[song_id] = os.path.join(sound_entries[f"{song_id}_ifs"].path, song_id)
+        else:
+            continue
+
+        for name, entry in sorted(scan_directory(sound_paths[song_id]).items()):
+            if name == f"{song_id}.1":
+                file_rows.append(get_file_row(song_id, "chart", entry))
+            elif name == f"{song_id}_pre.2dx":
+                file_rows.append(get_file_row(song_id, "preview", entry))
+            elif name.endswith(".2dx") or name.endswith(".s3p"):
+                file_rows.append(get_file_row(song_id, "container", entry))
+
+        if f"i_{song_id}_ifs" in graphic_entries:
+            title_image_entries = scan_directory(graphic_entries[f"i_{song_id}_ifs"].path)
+            if f"i_{song_id}.png" in title_image_entries:
+                file_rows.append(get_file_row(song_id, "title image", title_image_entries[f"i_{song_id}.png"]))
+        if f"{song_id}.jpg" in eyecatch_entries:
+            file_rows.append(get_file_row(song_id, "eyecatch", eyecatch_entries[f"{song_id}.jpg"]))
+        # custom videos take priority over the game's own
+        if f"{song_id}.mp4" in custom_video_entries:
+            file_rows.append(get_file_row(song_id, "video", custom_video_entries[f"{song_id}.mp4"]))
+        elif f"{song_id}.mp4" in movie_entries:
+            file_rows.append(get_file_row(song_id, "video", movie_entries[f"{song_id}.mp4"]))
+    return (sound_paths, file_rows)
+
+
+# On-disk SQLite index of the music database and the game files: song metadata, each chart's level, alternate
+# containers and the source files of every song, so a batch can be planned with queries instead of loading the
+# whole database and probing the filesystem song by song. Each song's inputs are fingerprinted when the index is
+# built, and the fingerprint is recorded again once the song is converted, so songs whose inputs changed since
+# their last conversion can be found without looking at their output.
+class SongIndex:
+    def __init__(self, path=INDEX_FILENAME):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        if self.get_meta("index_version") != str(INDEX_VERSION):
+            self._create_schema()
+
+    def _create_schema(self):
+        with self.connection:
+            for table in ["meta", "songs", "charts", "alt_containers", "files"]:
+                self.connection.execute(f"DROP TABLE IF EXISTS {table}")
+            self.connection.executescript(SCHEMA)
+            self.connection.execute("INSERT INTO meta VALUES ('index_version', ?)", (str(INDEX_VERSION),))
+
+    def get_meta(self, key):
+        try:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        except sqlite3.OperationalError:
+            # no meta table yet
+            return None
+        return None if row is None else row["value"]
+
+    # (Re)build the index from the music database, the alternate containers and a scan of contents_dir.
+    # Conversion fingerprints of songs that are still in the database are kept.
+    def build(self, contents_dir, music_database, alt_containers):
+        start_time = time.time()
+        (sound_paths, file_rows) = scan_song_files(contents_dir, music_database)
+        song_files = {}
+        for row in file_rows:
+            song_files.setdefault(row[0], []).append([row[1], os.path.basename(row[2]), row[3], row[4]])
+
+        song_rows = []
+        chart_rows = []
+        alt_container_rows = []
+        for song_id, db_entry in music_database.items():
+            song_alt_containers = alt_containers.get(song_id, {})
+            fingerprint = json.dumps([CONVERTER_VERSION, db_entry, song_alt_containers, song_files.get(song_id, [])],
+                                     sort_keys=True, ensure_ascii=False, default=str)
+            song_rows.append((song_id, db_entry.get("title"), db_entry.get("title_ascii"), db_entry.get("artist"),
+                              db_entry.get("genre"), json.dumps(db_entry, ensure_ascii=False), sound_paths.get(song_id),
+                              hashlib.sha256(fingerprint.encode()).hexdigest()))
+            for dir_index, chart_name in chart_names.items():
+                chart_rows.append((song_id, int(dir_index), chart_name, db_entry.get(get_level_field(dir_index), 0)))
+            for chart_name, container in song_alt_containers.items():
+                alt_container_rows.append((song_id, chart_name, container))
+
+        with self.connection:
+            converted_fingerprints = dict(self.connection.execute("SELECT song_id, converted_fingerprint FROM songs"))
+            for table in ["songs", "charts", "alt_containers", "files"]:
+                self.connection.execute(f"DELETE FROM {table}")
+            self.connection.executemany("INSERT INTO songs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                        [row + (converted_fingerprints.get(row[0]),) for row in song_rows])
+            self.connection.executemany("INSERT INTO charts VALUES (?, ?, ?, ?)", chart_rows)
+            self.connection.executemany("INSERT INTO alt_containers VALUES (?, ?, ?)", alt_container_rows)
+            self.connection.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?)", file_rows)
+            self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('contents_dir', ?)", (contents_dir,))
+            self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('built_at', ?)", (str(int(time.time())),))
+
+        info("Indexed %s song(s) (%s with sound files) in %.2fs.", len(song_rows), len(sound_paths), time.time() - start_time)
+
+    # Song ids, optionally only those with a chart_name (e.g. "DP-L") chart, whose inputs changed since they were
+    # last converted, or that have a sound directory
+    def find_songs(self, chart_name=None, changed_only=False, with_sound_only=False):
+        query = "SELECT song_id FROM songs WHERE 1"
+        parameters = []
+        if chart_name is not None:
+            query += " AND song_id IN (SELECT song_id FROM charts WHERE chart_name = ? AND level > 0)"
+            parameters.append(chart_name)
+        if changed_only:
+            query += " AND converted_fingerprint IS NOT inputs_fingerprint"
+        if with_sound_only:
+            query += " AND sound_path IS NOT NULL"
+        return [row["song_id"] for row in self.connection.execute(query + " ORDER BY song_id", parameters)]
+
+    def get_sound_path(self, song_id):
+        row = self.connection.execute("SELECT sound_path FROM songs WHERE song_id = ?", (song_id,)).fetchone()
+        return None if row is None else row["sound_path"]
+
+    # {chart name: level} of the song's charts that exist (level above 0)
+    def get_levels(self, song_id):
+        return dict(self.connection.execute("SELECT chart_name, level FROM charts WHERE song_id = ? AND level > 0 "
+                                            "ORDER BY dir_index", (song_id,)).fetchall())
+
+    # remember which inputs the song was converted from, so it only counts as changed once they change again
+    def mark_converted(self, song_id):
+        with self.connection:
+            self.connection.execute("UPDATE songs SET converted_fingerprint = inputs_fingerprint WHERE song_id = ?", (song_id,))
+
+    def close(self):
+        self.connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the song index of a game version and query it.")
+    parser.add_argument("contents_dir", help="game contents directory (containing data/sound)")
+    parser.add_argument("music_database", help="JSON file of db entries by song id")
+    parser.add_argument("--index", default=INDEX_FILENAME, help="SQLite index file")
+    parser.add_argument("--chart", default=None, choices=list(chart_names.values()), help="only list songs with this chart")
+    parser.add_argument("--changed", action="store_true", help="only list songs whose inputs changed since their last conversion")
+    args = parser.parse_args()
+
+    from batch import load_music_database
+    from elpis import get_alt_containers
+
+    song_index = SongIndex(args.index)
+    song_index.build(args.contents_dir, load_music_database(args.music_database), get_alt_containers())
+    for song_id in song_index.find_songs(args.chart, args.changed, with_sound_only=True):
+        levels = ", ".join(f"{chart_name} {level}" for chart_name, level in song_index.get_levels(song_id).items())
+        print(f"{song_id}  {levels}")
+    song_index.close()
+
+
+if __name__ == "__main__":
+    main()
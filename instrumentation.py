@@ -0,0 +1,140 @@
+import contextlib
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS just isn't reported there
+    resource = None
+
+from utils import *
+
+# spans currently open on each thread, innermost last
+open_spans = threading.local()
+
+
+class Span:
+    def __init__(self, phase):
+        self.phase = phase
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.child_wall = 0.0
+        self.child_cpu = 0.0
+
+    def add_bytes(self, read=0, written=0):
+        self.bytes_read += read
+        self.bytes_written += written
+
+
+# Time a phase of a song's conversion and add its wall time, CPU time and bytes read/written to the song's
+# summary. Time spent in spans nested inside it (on the same thread) only counts towards the innermost span,
+# so the phases of a song add up to its total. Without a summary, nothing is recorded.
+@contextlib.contextmanager
+def span(summary, phase):
+    current = Span(phase)
+    if summary is None:
+        yield current
+        return
+
+    stack = open_spans.__dict__.setdefault("stack", [])
+    stack.append(current)
+    start_wall = time.perf_counter()
+    start_cpu = time.thread_time()
+    try:
+        yield current
+    finally:
+        wall = time.perf_counter() - start_wall
+        cpu = time.thread_time() - start_cpu
+        stack.pop()
+        if stack:
+            stack[-1].child_wall += wall
+            stack[-1].child_cpu += cpu
+        summary.add_phase(phase, wall - current.child_wall, cpu - current.child_cpu,
+                          current.bytes_read, current.bytes_written)
+
+
+# Peak resident set size of this process since it started or since reset_peak_rss, in KiB
+def get_peak_rss_kb():
+    try:
+        with open("/proc/self/status", encoding="ascii") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux reports KiB
+    return peak_rss // 1024 if sys.platform == "darwin" else peak_rss
+
+
+# Start measuring the peak resident set size afresh, so it can be told apart from the peaks of earlier songs
+# converted by the same worker process. Only Linux can do this; returns whether it worked.
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="ascii") as file:
+            file.write("5")
+    except OSError:
+        return False
+    return True
+
+
+# CPU time used by finished child processes (ffmpeg), in seconds
+def get_child_cpu_seconds():
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+# Add up the phases of several songs' summaries into one run report
+def merge_phases(summaries):
+    phases = {}
+    for summary in summaries:
+        for phase, stats in summary.get("phases", {}).items():
+            total = phases.setdefault(phase, {"count": 0, "wall": 0.0, "cpu": 0.0, "bytes_read": 0, "bytes_written": 0})
+            for key in total:
+                total[key] += stats[key]
+    return {phase: {key: round(value, 6) if isinstance(value, float) else value for key, value in stats.items()}
+            for phase, stats in phases.items()}
+
+
+def get_run_report(summaries):
+    summaries = list(summaries)
+    peak_rss = [summary["peak_rss_kb"] for summary in summaries if summary.get("peak_rss_kb") is not None]
+    return {
+        "songs": len(summaries),
+        "seconds": round(sum(summary.get("seconds", 0) for summary in summaries), 3),
+        "child_cpu": round(sum(summary.get("child_cpu") or 0 for summary in summaries), 3),
+        "peak_rss_kb": max(peak_rss) if peak_rss else None,
+        "phases": merge_phases(summaries)
+    }
+
+
+# Phases as a plain text table, most expensive first. Wall times of phases that ran on several threads at once
+# are added up, so they can exceed the elapsed time.
+def format_phase_table(phases):
+    lines = [f"{'phase':<20} {'count':>7} {'wall s':>9} {'cpu s':>9} {'read MiB':>9} {'written MiB':>11}"]
+    for phase, stats in sorted(phases.items(), key=lambda item: item[1]["wall"], reverse=True):
+        lines.append(f"{phase:<20} {stats['count']:>7} {stats['wall']:>9.3f} {stats['cpu']:>9.3f} "
+                     f"{stats['bytes_read'] / 2 ** 20:>9.1f} {stats['bytes_written'] / 2 ** 20:>11.1f}")
+    return "\n".join(lines)
+
+
+# Run fn under cProfile, saving the stats to profile_path and logging the most expensive calls.
+# Only the calling thread is profiled; use task_workers=None and encode_workers=1 for a complete picture.
+def profile_call(profile_path, fn, *args, **kwargs):
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(fn, *args, **kwargs)
+    finally:
+        profiler.dump_stats(profile_path)
+        stats_text = io.StringIO()
+        pstats.Stats(profiler, stream=stats_text).sort_stats("cumulative").print_stats(20)
+        info("Profile saved to %s.\n%s", profile_path, stats_text.getvalue())
@@ -0,0 +1,58 @@
+import hashlib
+import json
+import os
+
+from utils import *
+
+# bump this whenever a change to the converter should invalidate previously converted songs
+CONVERTER_VERSION = 2
+
+MANIFEST_FILENAME = ".elpis-manifest.json"
+
+
+# Fingerprint a stage's inputs: the size and modification time of each input file (directories are walked),
+# plus any metadata the stage depends on, plus the converter version
+def get_inputs_fingerprint(paths, fields=None):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, filenames in os.walk(path):
+                files += [os.path.join(root, filename) for filename in filenames]
+        else:
+            files.append(path)
+
+    inputs = []
+    for file in sorted(files):
+        try:
+            stat = os.stat(file)
+            inputs.append([os.path.basename(file), stat.st_size, stat.st_mtime_ns])
+        except FileNotFoundError:
+            inputs.append([os.path.basename(file), None, None])
+
+    fingerprint = json.dumps([CONVERTER_VERSION, inputs, fields], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(fingerprint.encode()).hexdigest()
+
+
+# Per-song record of the input fingerprint each conversion stage was last built from, stored in the song's
+# output directory. On a rerun, only the stages whose fingerprint changed need to be redone.
+class BuildManifest:
+    def __init__(self, output_path, summary=None):
+        self.path = os.path.join(output_path, MANIFEST_FILENAME)
+        self.stages = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as file:
+                try:
+                    self.stages = json.load(file)["stages"]
+                except (ValueError, KeyError):
+                    warning("Build manifest %s is unreadable, rebuilding everything.", self.path, summary=summary)
+
+    def is_fresh(self, stage, fingerprint):
+        return self.stages.get(stage) == fingerprint
+
+    def record(self, stage, fingerprint):
+        self.stages[stage] = fingerprint
+
+    def save(self):
+        with open(self.path + ".tmp", "w", encoding="utf-8") as file:
+            json.dump({"converter_version": CONVERTER_VERSION, "stages": self.stages}, file, indent=1, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
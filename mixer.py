@@ -0,0 +1,164 @@
+import math
+import struct
+import subprocess
+import threading
+
+import numpy as np
+
+from utils import *
+
+# sample rate of mixed background tracks
+MIX_SAMPLE_RATE = 44100
+# torchaudio's default sinc interpolation settings, which the NumPy resampler reproduces
+LOWPASS_FILTER_WIDTH = 6
+ROLLOFF = 0.99
+
+
+# Mixing backends decode background samples into (channels, samples) float32 buffers at MIX_SAMPLE_RATE, and
+# provide the block buffer they're mixed into. Buffers of both backends support the same slicing and in-place
+# addition, so the mixer itself doesn't care which one it's using.
+
+
+# Pure NumPy backend: samples are decoded by ffmpeg and resampled with a polyphase port of torchaudio's
+# windowed sinc resampler, so it doesn't need PyTorch at all
+class NumpyMixer:
+    name = "numpy"
+
+    def __init__(self):
+        self.kernels = {}
+        self.lock = threading.Lock()
+
+    def load(self, file):
+        # decode to a float WAV stream, whose header carries the sample rate and channel count
+        decoded = subprocess.run(["ffmpeg", "-v", "quiet", "-i", file, "-f", "wav", "-acodec", "pcm_f32le", "pipe:1"],
+                                 check=True, capture_output=True).stdout
+        (sample_rate, channels, data_offset) = parse_wav_header(decoded)
+        # frames are interleaved, keep them as one row per channel
+        signal = np.frombuffer(decoded, dtype="<f4", offset=data_offset, count=(len(decoded) - data_offset) // 4)
+        signal = signal[:len(signal) - len(signal) % channels].reshape(-1, channels).T
+        return (signal, sample_rate)
+
+    def get_kernel(self, sample_rate):
+        with self.lock:
+            if sample_rate not in self.kernels:
+                self.kernels[sample_rate] = get_sinc_resample_kernel(sample_rate, MIX_SAMPLE_RATE)
+            return self.kernels[sample_rate]
+
+    def resample(self, signal, sample_rate):
+        (kernel, width, orig_freq, new_freq) = self.get_kernel(sample_rate)
+        (channels, length) = signal.shape
+        padded = np.pad(signal, ((0, 0), (width, width + orig_freq)))
+        # every orig_freq input samples produce new_freq output samples, one per phase of the kernel
+        windows = np.lib.stride_tricks.sliding_window_view(padded, kernel.shape[1], axis=1)[:, ::orig_freq]
+        resampled = np.matmul(windows, kernel.T).reshape(channels, -1)
+        return np.ascontiguousarray(resampled[:, :math.ceil(new_freq * length / orig_freq)], dtype=np.float32)
+
+    # mono samples are played on both channels, as a read-only view instead of a copy
+    def to_stereo(self, signal):
+        if signal.shape[0] == 1:
+            return np.broadcast_to(signal, (2, signal.shape[1]))
+        return signal
+
+    def zeros(self, length):
+        return np.zeros((2, length), dtype=np.float32)
+
+    # interleaved float32 frames, as the encoder expects them
+    def to_pcm_bytes(self, block):
+        return np.ascontiguousarray(block.T).tobytes()
+
+    def nbytes(self, signal):
+        return signal.shape[0] * signal.shape[1] * signal.itemsize
+
+
+# PyTorch backend, decoding with torchaudio and resampling with its Resample transform
+class TorchMixer:
+    name = "torch"
+
+    def __init__(self):
+        self.resamplers = {}
+        self.lock = threading.Lock()
+
+    def load(self, file):
+        import torchaudio
+
+        return torchaudio.load(file)
+
+    def resample(self, signal, sample_rate):
+        import torchaudio
+
+        with self.lock:
+            if sample_rate not in self.resamplers:
+                self.resamplers[sample_rate] = torchaudio.transforms.Resample(sample_rate, MIX_SAMPLE_RATE)
+            resampler = self.resamplers[sample_rate]
+        return resampler(signal)
+
+    def to_stereo(self, signal):
+        if signal.shape[0] == 1:
+            return signal.expand(2, -1)
+        return signal
+
+    def zeros(self, length):
+        import torch
+
+        return torch.zeros(2, length)
+
+    def to_pcm_bytes(self, block):
+        return block.t().contiguous().numpy().tobytes()
+
+    def nbytes(self, signal):
+        return signal.shape[0] * signal.shape[1] * signal.element_size()
+
+
+MIXERS = {"numpy": NumpyMixer, "torch": TorchMixer}
+mixers = {}
+mixers_lock = threading.Lock()
+
+
+# Shared instance of a mixing backend, so resampling kernels are only built once per process
+def get_mixer(name):
+    with mixers_lock:
+        if name not in mixers:
+            if name not in MIXERS:
+                error(f"Unknown mixing backend {name}, expected one of {', '.join(MIXERS)}.")
+            mixers[name] = MIXERS[name]()
+        return mixers[name]
+
+
+# Sample rate, channel count and data offset of a WAV stream. Chunk sizes of a streamed WAV can't be trusted
+# (they aren't known when the header is written), so everything after the data chunk header counts as data.
+def parse_wav_header(data):
+    if data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        error("Decoded audio is not a WAV stream, exiting...")
+    (sample_rate, channels) = (None, None)
+    offset = 12
+    while offset + 8 <= len(data):
+        (chunk_id, chunk_size) = struct.unpack_from("<4sI", data, offset)
+        if chunk_id == b'fmt ':
+            (channels, sample_rate) = struct.unpack_from("<HI", data, offset + 10)
+        elif chunk_id == b'data':
+            return (sample_rate, channels, offset + 8)
+        offset += 8 + chunk_size + chunk_size % 2
+    error("Decoded audio has no data, exiting...")
+
+
+# Polyphase filter bank resampling orig_freq to new_freq, built the same way as torchaudio's
+# _get_sinc_resample_kernel with a Hann window: one row of taps per output phase.
+# Returns the kernel, its padding width and the reduced frequencies.
+def get_sinc_resample_kernel(orig_freq, new_freq, lowpass_filter_width=LOWPASS_FILTER_WIDTH, rolloff=ROLLOFF):
+    gcd = math.gcd(orig_freq, new_freq)
+    orig_freq //= gcd
+    new_freq //= gcd
+
+    base_freq = min(orig_freq, new_freq) * rolloff
+    width = math.ceil(lowpass_filter_width * orig_freq / base_freq)
+    idx = np.arange(-width, width + orig_freq, dtype=np.float64)[None, :] / orig_freq
+    t = np.arange(0, -new_freq, -1, dtype=np.float64)[:, None] / new_freq + idx
+    t = np.clip(t * base_freq, -lowpass_filter_width, lowpass_filter_width)
+
+    window = np.cos(t * math.pi / lowpass_filter_width / 2) ** 2
+    t *= math.pi
+    scale = base_freq / orig_freq
+    with np.errstate(invalid="ignore", divide="ignore"):
+        kernel = np.where(t == 0, 1.0, np.sin(t) / t)
+    kernel *= window * scale
+    return (kernel.astype(np.float32), width, orig_freq, new_freq)
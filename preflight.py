@@ -0,0 +1,91 @@
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from audio import check_audio_container
+from elpis import KNOWN_EVENT_TYPES, decode_chart, get_chart_container_path, get_charts_to_parse, get_referenced_samples
+from utils import *
+from Misc_enums import *
+
+
+# Find what would make a song's conversion fail because of a mismatched chart or container, reading only the chart
+# file and the headers of its containers (including alternate ones), so nothing is extracted or encoded.
+# Returns the problems found, empty if the song looks fine.
+def preflight_song(song_id, db_entry, sound_path):
+    problems = []
+    (_, problem) = check_audio_container(os.path.join(sound_path, f"{song_id}_pre.2dx"))
+    if problem is not None:
+        problems.append(problem)
+
+    try:
+        with open(os.path.join(sound_path, f"{song_id}.1"), "rb") as chart_file:
+            chart_data = chart_file.read()
+    except FileNotFoundError:
+        return problems + [f"Chart file {song_id}.1 not found."]
+    if len(chart_data) < 96:
+        return problems + [f"Chart file {song_id}.1 is truncated."]
+    chart_directory = struct.unpack_from("<24I", chart_data)
+
+    container_path = ""
+    if os.path.exists(os.path.join(sound_path, f"{song_id}.2dx")):
+        container_path = os.path.join(sound_path, f"{song_id}.2dx")
+    elif os.path.exists(os.path.join(sound_path, f"{song_id}.s3p")):
+        container_path = os.path.join(sound_path, f"{song_id}.s3p")
+
+    containers = {}
+    for i in get_charts_to_parse(song_id, db_entry):
+        chart_name = chart_names[str(i)]
+        (chart_offset, chart_length) = chart_directory[i * 2:i * 2 + 2]
+        if chart_length == 0 or chart_offset + chart_length > len(chart_data):
+            problems.append(f"{chart_name}: chart is missing from {song_id}.1.")
+            continue
+
+        events = decode_chart(chart_data, chart_offset)
+        unknown_event_types = set(events["type"].tolist()) - set(KNOWN_EVENT_TYPES) - set(unknown_events)
+        if unknown_event_types:
+            problems.append(f"{chart_name}: unknown event type(s) {', '.join(hex(t) for t in sorted(unknown_event_types))}.")
+        if not np.any(events["type"] == 0x04):
+            problems.append(f"{chart_name}: no BPM events.")
+
+        chart_container_path = get_chart_container_path(song_id, i, container_path, sound_path)
+        if chart_container_path == "":
+            problems.append(f"{chart_name}: no audio container, and no alternate container either.")
+            continue
+        if chart_container_path not in containers:
+            containers[chart_container_path] = check_audio_container(chart_container_path)
+            if containers[chart_container_path][1] is not None:
+                problems.append(containers[chart_container_path][1])
+        (sample_count, problem) = containers[chart_container_path]
+        if problem is not None:
+            continue
+
+        highest_sample = max(get_referenced_samples(chart_data, chart_offset))
+        if highest_sample >= sample_count:
+            problems.append(f"{chart_name}: sample index {highest_sample} out of range for "
+                            f"{os.path.basename(chart_container_path)}, which has {sample_count} samples.")
+    return problems
+
+
+# Preflight every song in sound_paths ({song id: sound directory}) on a pool of threads, returning the problems of
+# the songs that have any
+def preflight_songs(music_database, sound_paths, workers=None):
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        futures = {song_id: pool.submit(preflight_song, song_id, music_database[song_id], sound_path)
+                   for song_id, sound_path in sound_paths.items()}
+    bad_songs = {}
+    for song_id, future in futures.items():
+        try:
+            problems = future.result()
+        except Exception as e:
+            problems = [f"Preflight failed: {type(e).__name__}: {e}"]
+        if problems:
+            bad_songs[song_id] = problems
+            for problem in problems:
+                warning("Song #%s: %s", song_id, problem)
+    info("Preflight checked %s song(s) in %.2fs, %s with problems.", len(sound_paths), time.time() - start_time,
+         len(bad_songs))
+    return bad_songs
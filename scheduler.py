@@ -0,0 +1,86 @@
+import heapq
+import itertools
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from utils import *
+
+
+# A unit of conversion work. fn is called with no arguments once every dependency has finished,
+# and its return value is kept in result. cost is a rough estimate of how long it takes.
+class Task:
+    def __init__(self, name, fn, dependencies=(), cost=1):
+        self.name = name
+        self.fn = fn
+        self.dependencies = list(dependencies)
+        self.dependents = []
+        self.cost = cost
+        self.priority = cost
+        self.result = None
+        self.error = None
+
+
+# Dependency graph of conversion tasks, run on a shared pool of worker threads. Whenever a worker is free, the
+# ready task with the most estimated work left along its path through the graph runs first, so the longest
+# chains get started early instead of holding up the end of the run.
+class TaskGraph:
+    def __init__(self):
+        self.tasks = []
+
+    def add(self, name, fn, dependencies=(), cost=1):
+        task = Task(name, fn, dependencies, cost)
+        for dependency in task.dependencies:
+            dependency.dependents.append(task)
+        self.tasks.append(task)
+        return task
+
+    # priority = own cost + the most expensive path through the tasks that depend on it
+    def _update_priorities(self):
+        for task in reversed(self._topological_order()):
+            task.priority = task.cost + max((dependent.priority for dependent in task.dependents), default=0)
+
+    def _topological_order(self):
+        remaining = {task: len(task.dependencies) for task in self.tasks}
+        order = [task for task in self.tasks if remaining[task] == 0]
+        for task in order:
+            for dependent in task.dependents:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    order.append(dependent)
+        if len(order) != len(self.tasks):
+            error("Task graph has a dependency cycle, exiting...")
+        return order
+
+    # Run every task. Once a task fails, nothing new is started; the tasks that failed are returned.
+    def run(self, workers=None):
+        self._update_priorities()
+        workers = workers or os.cpu_count() or 1
+        remaining = {task: len(task.dependencies) for task in self.tasks}
+        counter = itertools.count()
+        ready = [(-task.priority, next(counter), task) for task in self.tasks if remaining[task] == 0]
+        heapq.heapify(ready)
+
+        failed_tasks = []
+        running = {}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while ready or running:
+                while ready and len(running) < workers and not failed_tasks:
+                    (_, _, task) = heapq.heappop(ready)
+                    running[pool.submit(task.fn)] = task
+                if not running:
+                    break
+
+                (done, _) = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    try:
+                        task.result = future.result()
+                    except Exception as e:
+                        task.error = e
+                        failed_tasks.append(task)
+                        continue
+                    for dependent in task.dependents:
+                        remaining[dependent] -= 1
+                        if remaining[dependent] == 0:
+                            heapq.heappush(ready, (-dependent.priority, next(counter), dependent))
+        return failed_tasks
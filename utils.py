@@ -1,18 +1,167 @@
+import bisect
+import json
+import logging
+import os
+import shutil
 import sys
-from termcolor import cprint
+import threading
 
+import numpy as np
+from termcolor import colored
 
-def success(text):
-    cprint(text, "green")
+from Misc_enums import *
 
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, where files are only ever hardlinked or copied
+    fcntl = None
 
-def warning(text):
-    cprint("(?) " + text, "yellow")
+# extra log levels: TRACE for per-event and per-sample detail (off by default), SUCCESS for finished steps
+TRACE = 5
+SUCCESS = 25
+logging.addLevelName(TRACE, "TRACE")
+logging.addLevelName(SUCCESS, "SUCCESS")
 
+logger = logging.getLogger("elpis")
 
-def error(text):
-    cprint("[!] " + text, "red")
-    sys.exit()
+
+# Console output in the same style as before: plain progress messages, coloured successes, warnings and errors
+class ConsoleFormatter(logging.Formatter):
+    def format(self, record):
+        text = record.getMessage()
+        if record.levelno >= logging.ERROR:
+            return colored("[!] " + text, "red")
+        if record.levelno >= logging.WARNING:
+            return colored("(?) " + text, "yellow")
+        if record.levelno >= SUCCESS:
+            return colored(text, "green")
+        return text
+
+
+def setup_logging(level=logging.INFO):
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(ConsoleFormatter())
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(level)
+
+
+setup_logging()
+
+
+# Messages are %-style format strings, only formatted if their level is enabled
+def trace(text, *args):
+    logger.log(TRACE, text, *args)
+
+
+def debug(text, *args):
+    logger.debug(text, *args)
+
+
+def info(text, *args):
+    logger.info(text, *args)
+
+
+def success(text, *args):
+    logger.log(SUCCESS, text, *args)
+
+
+# warnings about a song are counted in its summary, if given
+def warning(text, *args, summary=None):
+    if summary is not None:
+        summary.add("warnings")
+    logger.warning(text, *args)
+
+
+# Raised by error() so a failing song can be caught and reported without ending a whole batch run
+class ConversionError(Exception):
+    pass
+
+
+def error(text, *args):
+    if args:
+        text = text % args
+    logger.error("%s", text)
+    raise ConversionError(text)
+
+
+# Counters for a song's conversion (events parsed, notes emitted, samples encoded, warnings...),
+# safe to update from the threads converting its charts and samples
+class Summary:
+    def __init__(self, **fields):
+        self.fields = dict(fields)
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    def add(self, key, count=1):
+        with self.lock:
+            self.fields[key] = self.fields.get(key, 0) + count
+
+    def set(self, key, value):
+        with self.lock:
+            self.fields[key] = value
+
+    # time and I/O spent in a phase of the conversion, see instrumentation.span
+    def add_phase(self, phase, wall, cpu, bytes_read=0, bytes_written=0):
+        with self.lock:
+            stats = self.phases.setdefault(phase, {"count": 0, "wall": 0.0, "cpu": 0.0, "bytes_read": 0, "bytes_written": 0})
+            stats["count"] += 1
+            stats["wall"] += wall
+            stats["cpu"] += cpu
+            stats["bytes_read"] += bytes_read
+            stats["bytes_written"] += bytes_written
+
+    def to_dict(self):
+        with self.lock:
+            fields = dict(self.fields)
+            if self.phases:
+                fields["phases"] = {phase: {key: round(value, 6) if isinstance(value, float) else value
+                                            for key, value in stats.items()}
+                                    for phase, stats in self.phases.items()}
+            return fields
+
+
+json_lines_lock = threading.Lock()
+
+
+# Append a record to a JSON-lines file, making sure it's on disk before returning
+def append_json_line(path, record):
+    with json_lines_lock, open(path, "a", encoding="utf-8") as file:
+        file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        file.flush()
+        os.fsync(file.fileno())
+
+
+# ioctl asking the filesystem for a copy-on-write clone of a file (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+
+# Put a file in place without duplicating its data if possible: hardlink it, or reflink it where it can't be
+# hardlinked, falling back to a copy (e.g. when crossing filesystems). Returns how the file was placed.
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+        return "hardlink"
+    except OSError:
+        pass
+    if fcntl is not None and sys.platform.startswith("linux"):
+        try:
+            with open(source, "rb") as infile, open(destination, "wb") as outfile:
+                fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+            return "reflink"
+        except OSError:
+            pass
+    shutil.copyfile(source, destination)
+    return "copy"
+
+
+# db entry field holding the level of a chart, e.g. "DPL_level" for DP-L (0 when the chart doesn't exist)
+def get_level_field(dir_index):
+    return chart_names[str(dir_index)].replace("-", "") + "_level"
 
 
 # For a specific offset in milliseconds and an array of bpm intervals, convert to pulses (where 1/4 note = 240 pulses)
@@ -32,3 +181,60 @@ def convert_to_pulses(offset_ms, tempo_changes, pulses_per_beat=240):
     ms_per_pulse = (60 * 1000) / (current_bpm * pulses_per_beat)
     pulses += (offset_ms - current_time) / ms_per_pulse
     return int(pulses)
+
+
+# Precomputed tempo map: built once per chart from its bpm intervals, then answers
+# millisecond-to-pulse lookups by binary search instead of walking every tempo change
+class TempoMap:
+    def __init__(self, tempo_changes, pulses_per_beat=240):
+        self.times = [change[0] for change in tempo_changes]
+        self.bpms = [change[1] for change in tempo_changes]
+        self.pulses_per_beat = pulses_per_beat
+
+        # cumulative pulse count at the start of each tempo change, accumulated the same way convert_to_pulses does
+        self.cumulative_pulses = []
+        current_bpm = self.bpms[0]
+        current_time = 0
+        pulses = 0
+        for time, bpm in zip(self.times, self.bpms):
+            ms_per_pulse = (60 * 1000) / (current_bpm * pulses_per_beat)
+            pulses += (time - current_time) / ms_per_pulse
+            self.cumulative_pulses.append(pulses)
+            current_time = time
+            current_bpm = bpm
+
+    def _exact_pulses(self, offset_ms):
+        i = bisect.bisect_right(self.times, offset_ms) - 1
+        if i < 0:
+            # before the first tempo change, extrapolate using the initial bpm
+            ms_per_pulse = (60 * 1000) / (self.bpms[0] * self.pulses_per_beat)
+            return offset_ms / ms_per_pulse
+        ms_per_pulse = (60 * 1000) / (self.bpms[i] * self.pulses_per_beat)
+        return self.cumulative_pulses[i] + (offset_ms - self.times[i]) / ms_per_pulse
+
+    # single lookup, equivalent to convert_to_pulses(offset_ms, tempo_changes)
+    def pulses(self, offset_ms):
+        return int(self._exact_pulses(offset_ms))
+
+    # batched lookup for an array of offsets
+    def pulses_many(self, offsets_ms):
+        offsets_ms = np.asarray(offsets_ms, dtype=np.float64)
+        times = np.asarray(self.times, dtype=np.float64)
+        bpms = np.asarray(self.bpms, dtype=np.float64)
+        cumulative_pulses = np.asarray(self.cumulative_pulses, dtype=np.float64)
+
+        indices = np.searchsorted(times, offsets_ms, side="right") - 1
+        before_first_change = indices < 0
+        indices = np.maximum(indices, 0)
+
+        ms_per_pulse = (60 * 1000) / (bpms[indices] * self.pulses_per_beat)
+        pulses = cumulative_pulses[indices] + (offsets_ms - times[indices]) / ms_per_pulse
+        pulses = np.where(before_first_change, offsets_ms / ms_per_pulse, pulses)
+        return pulses.astype(np.int64)
+
+    # lengths in pulses of holds starting at starts_ms, correct across tempo changes during the holds
+    def lengths_many(self, starts_ms, lengths_ms):
+        starts_ms = np.asarray(starts_ms, dtype=np.int64)
+        lengths_ms = np.asarray(lengths_ms, dtype=np.int64)
+        lengths = self.pulses_many(starts_ms + lengths_ms) - self.pulses_many(starts_ms)
+        return np.where(lengths_ms == 0, 0, lengths)